@@ -1,5 +1,22 @@
+from concurrent.futures import ProcessPoolExecutor  # parallel tries
 import numpy as np
 
+# default number of residuals computed at once when checking tries in vectorized mode; one
+# float and one boolean array of this size are allocated (about 38 MB), or of one try times the
+# number of data points if that is larger
+CHUNK_ELEMENTS = 1 << 22
+
+# default maximum number of tries checked at once in vectorized mode with a confidence target,
+# since the number of tries needed is only updated between chunks
+CHUNK_TRIES = 256
+
+# probability of rejecting a fit to inliers by the sequential probability ratio test
+SPRT_ALPHA = 0.01
+
+# number of data points checked in the first step of the sequential probability ratio test;
+# doubled at every step
+SPRT_BLOCK = 16
+
 class RansacPoly:
     '''
     Method to fit a k-th order polynomial function to a set of 2D noisy data points.
@@ -9,24 +26,61 @@ class RansacPoly:
         - if enough points match the fitted model refit the model using all matching data points
             - store best fit based on number of matched data points
         - redo all steps N times to find best fit
+    N is either fixed or, given a confidence target p, lowered as better fits are found to the
+    number of tries needed to pick only inliers at least once with probability p:
+        N = log(1 - p) / log(1 - w^s)
+    where w is the fraction of inliers of the best fit so far and s the number of data points
+    selected per try.
+    Optionally, fits are checked against the data points in random order with Wald's sequential
+    probability ratio test (SPRT) instead: after every data point the likelihood ratio of the fit
+    being based on outliers versus being at least as good as the best fit so far is updated, and
+    the fit is rejected as soon as the ratio exceeds 1 / SPRT_ALPHA. Most bad fits are rejected
+    after a few dozen data points.
+    The tries can be split across worker processes, each drawing data points from its own random
+    generator seeded from a common seed, so a fit can be repeated exactly for the same seed and
+    number of workers.
     '''
 
-    def __init__(self, nr_tries, max_dif, min_percent):
+    def __init__(self, nr_tries, max_dif, min_percent, vectorized=False, chunk_size=None,
+                 confidence=None, sprt_delta=None, n_jobs=1, seed=None):
         '''
         Args:
-            nr_tries:    number of tries to find the best fit
+            nr_tries:    (maximum) number of tries to find the best fit
             max_dif:     maximum difference between data points and fitted model to define inlieres
             min_percent: minimum percentage of data points that are considered inlieres
+            vectorized:  generate and check all tries at once with numpy array operations instead
+                         of one by one (optional)
+            chunk_size:  number of tries checked against all data points at once in vectorized
+                         mode; bounds memory use to about 9 bytes times 'chunk_size' times the
+                         number of data points (optional, default: CHUNK_ELEMENTS data points in
+                         total but at least one try, at most CHUNK_TRIES tries with a confidence
+                         target)
+            confidence:  probability of finding a fit based on inliers only, used to stop
+                         before 'nr_tries' tries (optional, e.g. 0.99)
+            sprt_delta:  fraction of data points matching a fit based on outliers; enables the
+                         SPRT (optional, e.g. 0.05)
+            n_jobs:      number of worker processes to split the tries across (optional)
+            seed:        seed of the random generators, for reproducible fits (optional)
         '''
 
         self.nr_tries = nr_tries
         self.max_dif = max_dif
         self.min_percent = min_percent
+        self.vectorized = vectorized
+        self.chunk_size = chunk_size
+        self.confidence = confidence
+        self.sprt_delta = sprt_delta
+        self.n_jobs = n_jobs
+        self.seed = seed
 
         self.__x = None  # numpy array of data point x-values
         self.__y = None  # numpy array of data point y-values
         self.__fit_params = None  # parameters of polynomial fit
         self.__sel_idx = None  # indices of selected data points (inliers)
+        self.__nr_tries = 0  # number of tries of the last fit
+        self.__nr_saved = 0  # number of data point checks skipped by the SPRT in the last fit
+        self.__max_tries = nr_tries  # number of tries of the current worker
+        self.__rng = None  # random generator of the current worker
 
     def set_2d_data(self, x, y):
         '''
@@ -62,41 +116,233 @@ class RansacPoly:
             print('please first provide the data points by calling "set_2d_data()"')
             return
 
+        # split tries across workers with independent random generators
+        seeds = np.random.SeedSequence(self.seed).spawn(self.n_jobs)
+        nr_tries = [self.nr_tries // self.n_jobs + (i < self.nr_tries % self.n_jobs)
+                    for i in range(self.n_jobs)]
+        if self.n_jobs == 1:
+            results = [self.search(poly_ord, nr_tries[0], seeds[0])]
+        else:
+            with ProcessPoolExecutor(max_workers=self.n_jobs) as pool:
+                results = list(pool.map(self.search, [poly_ord] * self.n_jobs, nr_tries, seeds))
+
+        # keep the selected data points of the best fit, the first worker's on a tie
+        self.__sel_idx = None
+        self.__nr_tries = sum(result[1] for result in results)
+        self.__nr_saved = sum(result[2] for result in results)
+        for sel_idx, _, _ in results:
+            if sel_idx is None:
+                continue
+            count = np.count_nonzero(sel_idx)
+            if self.__sel_idx is None or count > np.count_nonzero(self.__sel_idx):
+                self.__sel_idx = sel_idx
+
+        # get best fit
+        if self.__sel_idx is not None:
+            self.__fit_params = np.polynomial.polynomial.polyfit(self.__x[self.__sel_idx],
+                                                                 self.__y[self.__sel_idx],
+                                                                 poly_ord)
+        else:
+            self.__fit_params = None
+            print('unable to fit provided data points with current parameters')
+
+    def search(self, poly_ord, nr_tries, seed):
+        '''
+        Run up to 'nr_tries' tries of a fit and return the selected data points of the best fit
+        (or None), the number of tries run and the number of data point checks skipped by the
+        SPRT. Called by fit() for every worker, possibly in another process.
+        Args:
+            poly_ord: order of the polynomial function
+            nr_tries: maximum number of tries
+            seed:     numpy SeedSequence of the worker's random generator
+        '''
+
         self.__sel_idx = None
-        for i in range(self.nr_tries):
+        self.__nr_tries = 0
+        self.__nr_saved = 0
+        self.__max_tries = nr_tries
+        self.__rng = np.random.default_rng(seed)
+
+        # x-values mapped to [-1, 1], keeping the fits well conditioned for large x-values (e.g.
+        # timestamps); the final fit in fit() is done on the original x-values
+        x_min, x_max = self.__x.min(), self.__x.max()
+        x = (self.__x - (x_max + x_min) / 2) / ((x_max - x_min) / 2 or 1)
+
+        # Vandermonde matrix of the data points (one row per power), in random order for the SPRT
+        if self.vectorized or self.sprt_delta is not None:
+            order = slice(None)
+            if self.sprt_delta is not None:
+                order = self.__rng.permutation(self.__x.size)
+            vander = np.polynomial.polynomial.polyvander(x[order], poly_ord).T
+            y = self.__y[order].astype(float)
+
+        if self.vectorized:
+            self.__sel_idx = self.__fit_batch(poly_ord, x, vander, y)
+        for i in range(0 if self.vectorized else self.__max_tries):
+            if i >= nr_tries:
+                break
+            self.__nr_tries += 1
+
             # get 'poly_ord + 1' random data points
-            rnd_idx = np.random.randint(self.__x.size, size=poly_ord+1)
+            rnd_idx = self.__rng.integers(self.__x.size, size=poly_ord+1)
 
             try:
                 # fit model to selected data points
-                fit_params = np.polynomial.polynomial.polyfit(self.__x[rnd_idx],
-                                                              self.__y[rnd_idx],
+                fit_params = np.polynomial.polynomial.polyfit(x[rnd_idx], self.__y[rnd_idx],
                                                               poly_ord)
                 if fit_params is None or fit_params.size < poly_ord + 1:
                     continue
 
                 # check all data points against fitted model
-                val = np.polynomial.polynomial.polyval(self.__x, fit_params)
-                sel_idx = abs(val - self.__y) < self.max_dif  # selected data points
+                count_best = np.count_nonzero(self.__sel_idx)
+                if self.sprt_delta is None:
+                    val = np.polynomial.polynomial.polyval(x, fit_params)
+                    sel_idx = abs(val - self.__y) < self.max_dif  # selected data points
+                    count = np.count_nonzero(sel_idx)
+                else:
+                    count = self.__check(vander, y, fit_params[np.newaxis], count_best)[0]
+                    sel_idx = None
 
                 # store the selected data points that provide the best fit
-                count = np.count_nonzero(sel_idx)
-                count_best = np.count_nonzero(self.__sel_idx)
                 test_size = count > self.min_percent * self.__x.size
                 test_best = (self.__sel_idx is None) or (count > count_best)
                 if test_size and test_best:
+                    if sel_idx is None:
+                        val = np.polynomial.polynomial.polyval(x, fit_params)
+                        sel_idx = abs(val - self.__y) < self.max_dif
                     self.__sel_idx = sel_idx
+                    nr_tries = self.__get_nr_tries(count, poly_ord)
             except:
                 continue
 
-        # get best fit
-        if self.__sel_idx is not None:
-            self.__fit_params = np.polynomial.polynomial.polyfit(self.__x[self.__sel_idx],
-                                                                 self.__y[self.__sel_idx],
-                                                                 poly_ord)
-        else:
-            self.__fit_params = None
-            print('unable to fit provided data points with current parameters')
+        return self.__sel_idx, self.__nr_tries, self.__nr_saved
+
+    def __get_nr_tries(self, count, poly_ord):
+        ''' Return number of tries needed to reach the confidence target with 'count' inliers. '''
+
+        if self.confidence is None:
+            return self.__max_tries
+        inliers = (count / self.__x.size) ** (poly_ord + 1)  # probability to pick only inliers
+        if inliers >= 1:
+            return 1
+        nr_tries = np.log1p(-self.confidence) / np.log1p(-inliers)
+        return int(min(self.__max_tries, np.ceil(nr_tries)))
+
+    def __check(self, vander, y, fit_params, count_best):
+        '''
+        Return the number of data points matching each fit, or -1 for fits rejected by the SPRT.
+        Args:
+            vander:     (poly_ord + 1) x N Vandermonde matrix of the data points (in random order
+                        for the SPRT)
+            y:          y-values of the data points (same order)
+            fit_params: T x (poly_ord + 1) array with the parameters of T fits as rows
+            count_best: number of data points matching the best fit so far
+        '''
+
+        # fraction of data points matching a fit based on inliers
+        epsilon = min(max(count_best / y.size, self.min_percent), 1 - 1e-9)
+        if self.sprt_delta is None or epsilon <= self.sprt_delta:
+            return np.count_nonzero(self.__residuals(vander, y, fit_params) < self.max_dif, axis=1)
+
+        # log likelihood ratio steps for matching and other data points
+        step_in = np.log(self.sprt_delta / epsilon)
+        step_out = np.log((1 - self.sprt_delta) / (1 - epsilon))
+        limit = -np.log(SPRT_ALPHA)
+
+        count = np.zeros(len(fit_params), dtype=int)
+        ratio = np.zeros(len(fit_params))
+        active = np.arange(len(fit_params))  # fits not rejected yet
+        start, size = 0, SPRT_BLOCK
+        self.__nr_saved += y.size * active.size
+        while start < y.size and active.size:
+            # check the next block of data points against all active fits
+            stop = min(y.size, start + size)
+            sel_idx = self.__residuals(vander[:, start:stop], y[start:stop],
+                                       fit_params[active]) < self.max_dif
+            steps = ratio[active, np.newaxis] + np.cumsum(np.where(sel_idx, step_in, step_out),
+                                                          axis=1)
+            count[active] += np.count_nonzero(sel_idx, axis=1)
+            ratio[active] = steps[:, -1]
+            self.__nr_saved -= sel_idx.size
+
+            # reject fits whose ratio exceeded the limit at any data point of the block
+            rejected = np.any(steps > limit, axis=1)
+            count[active[rejected]] = -1
+            active = active[~rejected]
+            start, size = stop, 2 * size
+        return count
+
+    @staticmethod
+    def __residuals(vander, y, fit_params):
+        ''' Return T x N array of absolute differences between T fits and N data points. '''
+
+        # computed in place, so only one float array of T x N is allocated
+        val = fit_params @ vander
+        val -= y
+        return np.abs(val, out=val)
+
+    def __fit_batch(self, poly_ord, x, vander, y):
+        '''
+        Fit all tries, one chunk at a time, and return the selected data points of the best fit
+        or None. The 'poly_ord + 1' data points of each try in a chunk are stacked into one array
+        of Vandermonde matrices that is solved with a single call; tries with a singular matrix
+        (e.g. repeated x-values) are dropped.
+        Args:
+            poly_ord: order of the polynomial function
+            x:        x-values of the data points mapped to [-1, 1]
+            vander:   (poly_ord + 1) x N Vandermonde matrix of 'x' (in random order for the SPRT)
+            y:        y-values of the data points (same order as 'vander')
+        '''
+
+        # get 'poly_ord + 1' random data points for every try
+        rnd_idx = self.__rng.integers(self.__x.size, size=(self.__max_tries, poly_ord+1))
+
+        # check all data points against fitted models, one chunk of tries at a time
+        chunk_size = self.chunk_size or max(1, CHUNK_ELEMENTS // self.__x.size)
+        if self.chunk_size is None and self.confidence is not None:
+            chunk_size = min(chunk_size, CHUNK_TRIES)
+        nr_tries = self.__max_tries  # number of tries needed
+        count_best = 0
+        fit_best = None
+        for start in range(0, self.__max_tries, chunk_size):
+            if start >= nr_tries:
+                break
+            sample_x = x[rnd_idx[start:start+chunk_size]]
+            sample_y = self.__y[rnd_idx[start:start+chunk_size]].astype(float)
+            self.__nr_tries += len(sample_x)
+
+            # drop tries with repeated x-values
+            valid = np.all(np.diff(np.sort(sample_x, axis=1), axis=1) != 0, axis=1)
+            if not np.any(valid):
+                continue
+
+            # fit model to selected data points of all tries: vander[t] @ fit_params[t] = y[t]
+            samples = sample_x[valid, :, np.newaxis] ** np.arange(poly_ord + 1)
+            try:
+                fit_params = np.linalg.solve(samples, sample_y[valid, :, np.newaxis])[:, :, 0]
+            except np.linalg.LinAlgError:
+                # numerically singular tries; solve one by one and drop the failing ones
+                fit_params = np.full((len(samples), poly_ord + 1), np.nan)
+                for t in range(len(samples)):
+                    try:
+                        fit_params[t] = np.linalg.solve(samples[t], sample_y[valid][t])
+                    except np.linalg.LinAlgError:
+                        continue
+                fit_params = fit_params[~np.isnan(fit_params).any(axis=1)]
+                if not len(fit_params):
+                    continue
+            count = self.__check(vander, y, fit_params, count_best)
+
+            # keep the first try with the most selected data points, if there are enough of them
+            best = np.argmax(count)
+            if count[best] > max(count_best, self.min_percent * self.__x.size):
+                count_best = count[best]
+                fit_best = fit_params[best]
+                nr_tries = self.__get_nr_tries(count_best, poly_ord)
+
+        if fit_best is None:
+            return None
+        return abs(np.polynomial.polynomial.polyval(x, fit_best) - self.__y) < self.max_dif
 
     def get_fit_params(self):
         ''' Return fit parameters. '''
@@ -105,3 +351,11 @@ class RansacPoly:
     def get_inliers(self):
         ''' Return indices of selected data points (inliers). '''
         return self.__sel_idx
+
+    def get_nr_tries(self):
+        ''' Return number of tries run by the last fit. '''
+        return self.__nr_tries
+
+    def get_nr_saved(self):
+        ''' Return number of data point checks skipped by the SPRT in the last fit. '''
+        return self.__nr_saved
@@ -1,23 +1,98 @@
 #! /usr/local/bin/python3
 
-from datafit.ransacpoly import RansacPoly
-import matplotlib.pyplot as plt
 import numpy as np
+from ransacpoly import RansacPoly
 
-def test_ransacpoly(x_min, x_max, N):
+def make_data(x_min, x_max, N, seed=0):
     '''
-    Test the RANSAC method on a set of generated data points and plot the results.
+    Return N generated data points along the line y = x, with random noise on all of them and
+    extra noise on about half of them.
+    '''
+
+    rng = np.random.default_rng(seed)
+    x = np.linspace(x_min, x_max, N)  # generate N points between x_min and x_max
+    y = x + rng.normal(0, 1, N) + rng.normal(0, 5, N) * (rng.random(N) > 0.5)
+    return x, y
+
+def run_ransacpoly(x, y, poly_ord=1, **kwargs):
+    ''' Fit the data points and return the fitted RansacPoly object. '''
+
+    ransac_poly = RansacPoly(nr_tries=100, max_dif=3, min_percent=0.5, **kwargs)
+    ransac_poly.set_2d_data(x, y)
+    ransac_poly.fit(poly_ord=poly_ord)
+    return ransac_poly
+
+def assert_same_fit(a, b):
+    ''' Check two RansacPoly objects found the same inliers and fit parameters. '''
+
+    assert a.get_fit_params() is not None and b.get_fit_params() is not None
+    assert np.array_equal(a.get_inliers(), b.get_inliers())
+    assert np.allclose(a.get_fit_params(), b.get_fit_params())
+
+def test_fit():
+    x, y = make_data(1, 50, 1000)
+    ransac_poly = run_ransacpoly(x, y)
+    assert np.allclose(ransac_poly.get_fit_params(), [0, 1], atol=0.5)
+    assert np.count_nonzero(ransac_poly.get_inliers()) > 0.5 * x.size
+    assert ransac_poly.get_nr_tries() == 100
+
+def test_seed():
+    x, y = make_data(1, 50, 1000)
+    for n_jobs in (1, 3):
+        assert_same_fit(run_ransacpoly(x, y, n_jobs=n_jobs, seed=1),
+                        run_ransacpoly(x, y, n_jobs=n_jobs, seed=1))
+
+def test_vectorized():
+    x, y = make_data(1, 50, 1000)
+    for poly_ord in (1, 2):
+        assert_same_fit(run_ransacpoly(x, y, poly_ord, seed=1),
+                        run_ransacpoly(x, y, poly_ord, vectorized=True, seed=1))
+
+def test_chunk_size():
+    x, y = make_data(1, 50, 1000)
+    for chunk_size in (1, 7, 1000):
+        assert_same_fit(run_ransacpoly(x, y, vectorized=True, seed=1),
+                        run_ransacpoly(x, y, vectorized=True, chunk_size=chunk_size, seed=1))
+
+def test_large_x():
+    # x-values like timestamps, for which the systems of raw x-values are singular
+    x = 1.7e9 + np.arange(5000) * 0.01
+    y = (x - x[0]) ** 2 / 100 + np.random.default_rng(0).normal(0, 0.1, x.size)
+    for poly_ord in (2, 3):
+        loop = run_ransacpoly(x, y, poly_ord, seed=1)
+        vectorized = run_ransacpoly(x, y, poly_ord, vectorized=True, seed=1)
+        assert np.count_nonzero(loop.get_inliers()) > 0.9 * x.size
+        assert np.array_equal(loop.get_inliers(), vectorized.get_inliers())
+
+def test_confidence():
+    x, y = make_data(1, 50, 1000)
+    # the number of tries needed is only updated between chunks in vectorized mode
+    for vectorized, chunk_size in ((False, None), (True, 10)):
+        ransac_poly = run_ransacpoly(x, y, vectorized=vectorized, chunk_size=chunk_size,
+                                     confidence=0.99, seed=1)
+        assert ransac_poly.get_fit_params() is not None
+        assert ransac_poly.get_nr_tries() < 100
+
+def test_sprt():
+    x, y = make_data(1, 50, 1000)
+    for vectorized in (False, True):
+        ransac_poly = run_ransacpoly(x, y, vectorized=vectorized, sprt_delta=0.05, seed=1)
+        assert np.allclose(ransac_poly.get_fit_params(), [0, 1], atol=0.5)
+        assert ransac_poly.get_nr_saved() > 0
+
+def plot_ransacpoly(x_min, x_max, N):
+    '''
+    Fit a set of generated data points with the RANSAC method and plot the results.
     Args:
         x_min: lower limit for x
         x_max: upper limit for x
         N:     number of points between x_min and x_max
     '''
 
-    # generate points with random noise
-    x = np.linspace(x_min, x_max, N)  # generate N points between x_min and x_max
-    y = x + np.random.normal(0, 1, N) + np.random.normal(0, 5, N) * (np.random.rand(N) > 0.5)
+    import matplotlib.pyplot as plt
 
     # ransac poly fit
+    x, y = make_data(x_min, x_max, N, seed=None)
     ransac_poly = RansacPoly(nr_tries=100, max_dif=3, min_percent=0.7)
     ransac_poly.set_2d_data(x, y)
     ransac_poly.fit(poly_ord=1)
@@ -46,4 +121,4 @@ def test_ransacpoly(x_min, x_max, N):
     plt.show()
 
 if __name__ == '__main__':
-    test_ransacpoly(x_min=1, x_max=50, N=100)
+    plot_ransacpoly(x_min=1, x_max=50, N=100)
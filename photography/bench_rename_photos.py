@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+import os
+import random
+import shutil
+import struct
+import tempfile
+import time as clock
+
+from rename_photos import (NameIndex, apply_plan, get_creation_time, plan_renames,
+                           read_creation_times, scan_photos)
+
+# largest maker note that still fits into the exif segment of a jpeg file
+JPEG_MAKERNOTE = 60000
+
+def make_tiff(time=None, subsec=None, makernote=0, order='<'):
+    '''
+    Return a minimal tiff structure with IFD0 pointing to an exif IFD.
+    Args:
+        time:      DateTimeOriginal as yyyy:mm:dd hh:mm:ss (optional; left out if missing)
+        subsec:    SubSecTimeOriginal (optional)
+        makernote: size of a random MakerNote stored ahead of the exif IFD (optional)
+        order:     byte order, '<' (intel) or '>' (motorola) (optional)
+    '''
+
+    # exif entries: (tag, type, value); type 2 is ascii, 7 is undefined
+    entries = []
+    if time is not None:
+        entries.append((0x9003, 2, time.encode() + b'\x00'))
+    if subsec is not None:
+        entries.append((0x9291, 2, subsec.encode() + b'\x00'))
+    if makernote:
+        entries.append((0x927C, 7, os.urandom(makernote)))
+
+    # layout: header, IFD0 (one entry), values too large for an entry, exif IFD
+    ifd0 = 8
+    data = ifd0 + 2 + 12 + 4
+    values = b''
+    offsets = []
+    for tag, kind, value in entries:
+        offsets.append(data + len(values))
+        if len(value) > 4:
+            values += value + b'\x00' * (len(value) % 2)
+    exif_ifd = data + len(values)
+
+    tiff = (b'II*\x00' if order == '<' else b'MM\x00*') + struct.pack(order + 'I', ifd0)
+    tiff += struct.pack(order + 'HHHII', 1, 0x8769, 4, 1, exif_ifd) + struct.pack(order + 'I', 0)
+    tiff += values + struct.pack(order + 'H', len(entries))
+    for (tag, kind, value), offset in zip(entries, offsets):
+        if len(value) > 4:
+            tiff += struct.pack(order + 'HHII', tag, kind, len(value), offset)
+        else:
+            tiff += struct.pack(order + 'HHI', tag, kind, len(value)) + value.ljust(4, b'\x00')
+    return tiff + struct.pack(order + 'I', 0)
+
+def make_jpeg(tiff, size=0):
+    '''
+    Return a jpeg file holding 'tiff' in its exif segment, followed by 'size' bytes of image data.
+    '''
+
+    exif = b'Exif\x00\x00' + tiff
+    return (b'\xff\xd8\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif +
+            b'\xff\xda\x00\x02' + os.urandom(size) + b'\xff\xd9')
+
+def generate_photos(folder, N, seed=0, missing=0.05, duplicates=0.2, makernotes=0.1):
+    '''
+    Write N synthetic photos to a folder, half of them as jpeg and half as tiff based raw (dng)
+    files, and return the number of files with a creation time.
+    Args:
+        folder:     location to write the photos to (created if missing)
+        N:          number of photos
+        seed:       seed of the random generator, so the same set is generated each time
+                    (optional)
+        missing:    fraction of photos without DateTimeOriginal (optional)
+        duplicates: fraction of photos sharing the creation time of the previous one, like
+                    photos of a burst (optional)
+        makernotes: fraction of photos with a large maker note ahead of the exif IFD (optional)
+    '''
+
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    time = 1700000000
+    found = 0
+    for i in range(N):
+        if rng.random() >= duplicates:
+            time += rng.randint(1, 600)
+        stamp = clock.strftime('%Y:%m:%d %H:%M:%S', clock.gmtime(time))
+        raw = i % 2 == 1
+        if rng.random() < missing:
+            stamp = None
+        else:
+            found += 1
+        makernote = 0
+        if rng.random() < makernotes:
+            makernote = rng.randint(1 << 16, 1 << 20) if raw else JPEG_MAKERNOTE
+        tiff = make_tiff(stamp, '%03d' % rng.randint(0, 999), makernote, rng.choice('<>'))
+        name = os.path.join(folder, 'IMG_%06d.%s' % (i, 'dng' if raw else 'jpg'))
+        with open(name, 'wb') as f:
+            f.write(tiff + os.urandom(1024) if raw else make_jpeg(tiff, 1024))
+    return found
+
+def measure(function, N):
+    ''' Call 'function' and return the number of files per second it processed, N files total. '''
+
+    start = clock.perf_counter()
+    function()
+    return N / max(clock.perf_counter() - start, 1e-9)
+
+def bench_rename_photos(N, jobs=1, folder=None):
+    '''
+    Generate N photos in a temporary folder and print the files per second of scanning the
+    folder, extracting the creation times (one by one and with 'jobs' readers) and renaming the
+    photos.
+    Args:
+        N:      number of photos
+        jobs:   number of files to read exif metadata from in parallel (optional)
+        folder: location to create the temporary folder in (optional)
+    '''
+
+    location = tempfile.mkdtemp(prefix='bench_rename_photos_', dir=folder)
+    try:
+        found = generate_photos(location, N)
+        files = list(scan_photos(location))
+        results = [('scan', measure(lambda: list(scan_photos(location)), N)),
+                   ('extract', measure(lambda: [get_creation_time(f) for f in files], N)),
+                   ('extract (%d jobs)' % jobs,
+                    measure(lambda: list(read_creation_times(files, jobs)), N))]
+
+        # plan in advance, so only the renames are timed
+        names = NameIndex()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            plan = list(plan_renames(files, jobs, names=names))
+            results.append(('rename', measure(lambda: apply_plan(plan, names),
+                                              sum(len(steps) for steps in plan))))
+    finally:
+        shutil.rmtree(location)
+
+    print('\n%d files, %d with creation time' % (N, found))
+    for stage, rate in results:
+        print('%-20s %12.0f files/s' % (stage, rate))
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description='benchmark rename_photos on synthetic photos')
+    parser.add_argument('sizes', metavar='N', type=int, nargs='*', default=[1000, 10000, 100000],
+                        help='numbers of photos to benchmark with')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=4,
+                        help='number of files to read exif metadata from in parallel')
+    parser.add_argument('-d', '--dir', metavar='name',
+                        help='location to generate the photos in (default: system temp folder)')
+    args = parser.parse_args()
+    for N in args.sizes:
+        bench_rename_photos(N, args.jobs, args.dir)
@@ -1,78 +1,1820 @@
 #!/usr/bin/python3
 
 from argparse import ArgumentParser
-import exifread  # read exif metadata
+from collections import deque, namedtuple, OrderedDict
+import ctypes  # renameat2 and inotify system calls
+import errno
+import hashlib  # copy verification
+import json  # rename journal records
 import os, sys
+import queue
+import random
+import re  # regular expression operations
+import signal  # clean shutdown on SIGTERM
+import stat  # socket file check
+import struct  # inotify events
+import threading
+import time as clock
+
+# slow to import and only needed by some runs, so imported where used to keep startup fast:
+# asyncio (pipelined exif extraction), concurrent.futures (parallel exif extraction), cProfile
+# (profiling), exifread (fallback exif parser), socketserver (server mode) and sqlite3 (metadata
+# cache); fcntl (fiemap ioctl) is imported where used as well, since it only exists on posix
+# systems
+
+# creation time extractors by file extension (see register_extractor); also defines which
+# file extensions are valid
+EXTRACTORS = dict()
+
+# sidecar files renamed together with their photos (see group_files)
+SIDECARS = ['xmp']
+
+# file extensions in the order they are preferred for reading the creation time of a group;
+# other photo formats come after these
+READ_ORDER = ['jpg', 'jpeg', 'heic', 'heif']
+
+# creation time format used in exif metadata
+TIME_PATTERN = re.compile(r'\d{4}:\d{2}:\d{2} \d{2}:\d{2}:\d{2}')
+
+# seconds between the quicktime epoch (1904-01-01) and the unix epoch (1970-01-01)
+MAC_EPOCH = 2082844800
+
+# uuid of the canon cr3 box holding the exif metadata
+CR3_UUID = bytes.fromhex('85c0b687820f11e08111f4ce462b6a48')
+
+# names generated by this tool: yyyymmdd_hhmmss(-sss)(_cc).ext, where sidecars keep the
+# extension of their photo (e.g. .nef.xmp)
+NAME_PATTERN = re.compile(r'(\d{8}_\d{6}(?:-\d+)?)(?:_\d+)?(?:\.[^.]+)+')
+
+# single step of a rename plan: old path, new path, creation time used for the new name,
+# instead of a new path an existing file with identical content, and the new name without
+# duplicate counter and file extension
+RenameStep = namedtuple('RenameStep', ['src', 'dst', 'time', 'duplicate', 'base'],
+                        defaults=[None, None])
+
+# number of times a group is given the next free name when the planned one was taken meanwhile,
+# before it is skipped
+MAX_RETRIES = 100
+
+# actions applied to files identical to one already on disk
+DEDUP_ACTIONS = ['skip', 'link', 'delete']
+
+# size of the file header prefetched ahead of reading exif metadata
+PREFETCH_SIZE = 1 << 16
+
+# fiemap ioctl (linux only); used to find the physical location of files on disk
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FLAG_SYNC = 0x00000001
+
+# number of entries and seconds after which new entries of the metadata cache are committed, so
+# long running modes (--watch, --serve) don't keep a write transaction open
+CACHE_COMMIT_SIZE = 256
+CACHE_COMMIT_INTERVAL = 5.0
+
+# default location of the metadata cache
+CACHE_NAME = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                          'rename_photos.db')
+
+# c library, used for system calls not wrapped by the os module
+try:
+    libc = ctypes.CDLL(None, use_errno=True)
+except (OSError, TypeError):
+    libc = None
+
+# renameat2 system call (linux only); used to rename files without overwriting existing ones
+renameat2 = getattr(libc, 'renameat2', None)
+if renameat2 is not None:
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+
+# inotify system calls (linux only); used to watch folders for new photos
+inotify_init1 = getattr(libc, 'inotify_init1', None)
+inotify_add_watch = getattr(libc, 'inotify_add_watch', None)
+if inotify_add_watch is not None:
+    inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+
+def rename_noreplace(src, dst, src_dir_fd=None, dst_dir_fd=None):
+    '''
+    Rename file 'src' to 'dst', raising FileExistsError instead of overwriting an existing 'dst'.
+    Uses renameat2(RENAME_NOREPLACE) where supported, otherwise a hard link followed by unlink.
+    Args:
+        src:        old path
+        dst:        new path
+        src_dir_fd: folder file descriptor 'src' is relative to (optional)
+        dst_dir_fd: folder file descriptor 'dst' is relative to (optional)
+    '''
+
+    if renameat2 is not None:
+        if renameat2(AT_FDCWD if src_dir_fd is None else src_dir_fd, os.fsencode(src),
+                     AT_FDCWD if dst_dir_fd is None else dst_dir_fd, os.fsencode(dst),
+                     RENAME_NOREPLACE) == 0:
+            return
+        err = ctypes.get_errno()
+        if err not in (errno.EINVAL, errno.ENOSYS):  # flag not supported by the file system
+            raise OSError(err, os.strerror(err), src, None, dst)
+
+    try:
+        os.link(src, dst, src_dir_fd=src_dir_fd, dst_dir_fd=dst_dir_fd)
+    except FileExistsError:
+        raise
+    except OSError:
+        # file systems without hard links (e.g. exfat on memory cards)
+        try:
+            os.stat(dst, dir_fd=dst_dir_fd, follow_symlinks=False)
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), src, None, dst)
+        except FileNotFoundError:
+            os.rename(src, dst, src_dir_fd=src_dir_fd, dst_dir_fd=dst_dir_fd)
+            return
+    os.unlink(src, dir_fd=src_dir_fd)
+
+def copy_noreplace(src, dst, dst_dir_fd=None):
+    '''
+    Copy file 'src' to 'dst', raising FileExistsError instead of overwriting an existing 'dst'.
+    The data is copied inside the kernel with copy_file_range or sendfile where possible and the
+    file is created under its final name, so there is no temporary file to rename afterwards.
+    If the copy fails or is interrupted, the partial file is removed again.
+    Args:
+        src:        path to file to copy
+        dst:        path to new file
+        dst_dir_fd: folder file descriptor 'dst' is relative to (optional)
+    '''
+
+    with open(src, 'rb') as fin:
+        st = os.fstat(fin.fileno())
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644, dir_fd=dst_dir_fd)
+        try:
+            with open(fd, 'wb') as fout:
+                try:
+                    copied = 0
+                    while copied < st.st_size:
+                        if hasattr(os, 'copy_file_range'):
+                            try:
+                                size = os.copy_file_range(fin.fileno(), fout.fileno(),
+                                                          st.st_size - copied)
+                            except OSError:  # e.g. across file systems on older kernels
+                                size = os.sendfile(fout.fileno(), fin.fileno(), None,
+                                                   st.st_size - copied)
+                        else:
+                            size = os.sendfile(fout.fileno(), fin.fileno(), None,
+                                               st.st_size - copied)
+                        if size == 0:
+                            break
+                        copied += size
+                except OSError:
+                    # no in-kernel copy available; start over in user space
+                    fin.seek(0)
+                    fout.seek(0)
+                    fout.truncate()
+                    for chunk in iter(lambda: fin.read(1 << 20), b''):
+                        fout.write(chunk)
+                fout.flush()
+                os.utime(fout.fileno(), ns=(st.st_atime_ns, st.st_mtime_ns))
+                os.fsync(fout.fileno())
+        except BaseException:
+            # don't leave a truncated file under the final name (e.g. disk full or ctrl-c)
+            os.unlink(dst, dir_fd=dst_dir_fd)
+            raise
+
+def get_checksum(file, dir_fd=None, cached=True):
+    '''
+    Return blake2b digest of a file, reading it in chunks.
+    Args:
+        file:   path to file
+        dir_fd: folder file descriptor 'file' is relative to (optional)
+        cached: if False the file is dropped from the page cache first, so the data is read back
+                from the storage device (optional)
+    '''
+
+    checksum = hashlib.blake2b()
+    fd = os.open(file, os.O_RDONLY, dir_fd=dir_fd)
+    with open(fd, 'rb') as f:
+        if not cached and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            checksum.update(chunk)
+    return checksum.digest()
+
+def get_partial_checksum(file, block=1 << 16):
+    '''
+    Return blake2b digest of the size, first and last block of a file; a cheap filter applied
+    before comparing full checksums.
+    Args:
+        file:  path to file
+        block: size of the blocks in bytes (optional)
+    '''
+
+    checksum = hashlib.blake2b()
+    with open(file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        checksum.update(str(size).encode())
+        checksum.update(f.read(block))
+        if size > 2 * block:
+            f.seek(-block, os.SEEK_END)
+        checksum.update(f.read(block))
+    return checksum.digest()
+
+def find_duplicate(file, candidates, checksums):
+    '''
+    Return the first candidate with the same content as 'file' or None. Candidates are compared
+    by size first, then by partial checksum and only then by full checksum.
+    Args:
+        file:       path to file
+        candidates: paths to files that might be identical (e.g. same creation time)
+        checksums:  dict used to remember partial and full checksums between calls
+    '''
+
+    def checksum(path, full):
+        if (path, full) not in checksums:
+            checksums[(path, full)] = get_checksum(path) if full else get_partial_checksum(path)
+        return checksums[(path, full)]
+
+    size = os.path.getsize(file)
+    for candidate in candidates:
+        try:
+            if (os.path.getsize(candidate) == size and
+                checksum(candidate, False) == checksum(file, False) and
+                checksum(candidate, True) == checksum(file, True)):
+                return candidate
+        except FileNotFoundError:
+            continue  # removed meanwhile
+    return None
+
+class FolderCache:
+    '''
+    Open file descriptors of the folders files are renamed in or moved to. Each folder is created
+    and resolved only once (while it stays among the most recently used ones), and renames are
+    done relative to the descriptors instead of resolving full paths every time.
+    '''
+
+    def __init__(self, size=256):
+        '''
+        Args:
+            size: maximum number of open folders (optional)
+        '''
+
+        self.__fds = OrderedDict()  # folder -> file descriptor, least recently used first
+        self.__size = size
+
+    def open(self, folder):
+        ''' Return file descriptor of 'folder', creating the folder if it doesn't exist. '''
+
+        fd = self.__fds.pop(folder, None)
+        if fd is None:
+            try:
+                fd = os.open(folder or '.', os.O_RDONLY | os.O_DIRECTORY)
+            except FileNotFoundError:
+                os.makedirs(folder, exist_ok=True)
+                fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+            if len(self.__fds) >= self.__size:
+                os.close(self.__fds.popitem(last=False)[1])
+        self.__fds[folder] = fd
+        return fd
+
+    def close(self):
+        ''' Close all folders. '''
+        while self.__fds:
+            os.close(self.__fds.popitem()[1])
+
+class NameIndex:
+    '''
+    Names taken in each folder, used to generate names that don't collide with files already on
+    disk or generated earlier in the run. Each folder is listed once, the first time it is used,
+    so all collision checks are set lookups.
+    '''
+
+    def __init__(self):
+        self.__names = dict()  # folder -> set of taken names
+        self.__groups = dict()  # folder -> {base name -> set of taken names of the form base(_cc).*}
+        # (folder, base name, file extensions) -> last duplicate counter used
+        self.__counters = dict()
+
+    def __taken(self, folder):
+        if folder not in self.__names:
+            try:
+                self.__names[folder] = set(os.listdir(folder or '.'))
+            except FileNotFoundError:
+                self.__names[folder] = set()  # folder to be created
+            self.__groups[folder] = dict()
+            for name in self.__names[folder]:
+                self.__group(folder, name, True)
+        return self.__names[folder]
+
+    def __group(self, folder, name, taken):
+        m = NAME_PATTERN.fullmatch(name)
+        if m is None:
+            return
+        group = self.__groups[folder].setdefault(m.group(1), set())
+        if taken:
+            group.add(name)
+        else:
+            group.discard(name)
+
+    def group(self, folder, base):
+        ''' Return taken names of the form base(_cc).ext in 'folder'. '''
+        self.__taken(folder)
+        return self.__groups[folder].get(base, set())
+
+    def allocate(self, folder, base, ftype, current=None):
+        '''
+        Return first free name of the form base(_cc).ftype and mark it as taken.
+        Args:
+            folder:  folder of the new name
+            base:    name without duplicate counter and file extension
+            ftype:   file extension
+            current: present name of the file to be renamed, which it is free to keep (optional)
+        '''
+
+        return self.allocate_group(folder, base, [ftype],
+                                   None if current is None else [current])[0]
+
+    def allocate_group(self, folder, base, ftypes, current=None):
+        '''
+        Return first free names of the form base(_cc).ftype sharing the same counter for all
+        file extensions and mark them as taken.
+        Args:
+            folder:  folder of the new names
+            base:    name without duplicate counter and file extension
+            ftypes:  list of file extensions
+            current: present names of the files to be renamed, which they are free to keep if
+                     they share a valid name (optional)
+        '''
+
+        # keep present names if they already follow the format
+        if current is not None:
+            stems = set()
+            for name, ftype in zip(current, ftypes):
+                stems.add(name[:-len(ftype)-1] if name.endswith('.' + ftype) else None)
+            stem = stems.pop() if len(stems) == 1 else None
+            if stem is not None and stem.startswith(base):
+                counter = stem[len(base):]
+                if not counter or (counter[0] == '_' and counter[1:].isdigit()):
+                    return current
+
+        taken = self.__taken(folder)
+        key = (folder, base, tuple(ftypes))
+        count = self.__counters.get(key, 1)
+        while True:
+            stem = base + ('_{:0>2}'.format(count) if count > 1 else '')
+            names = [stem + '.' + ftype for ftype in ftypes]
+            if not any(name in taken for name in names):
+                break
+            count += 1
+        self.__counters[key] = count
+        for name in names:
+            taken.add(name)
+            self.__group(folder, name, True)
+        return names
+
+    def release(self, folder, name):
+        ''' Mark 'name' as free again, e.g. after the file was renamed. '''
+        self.__taken(folder).discard(name)
+        self.__group(folder, name, False)
+
+class RunStats:
+    '''
+    Counters and per-stage latency histograms of a run, to find out whether a run is bound by
+    listing folders, reading files, parsing metadata or renaming files. Latencies are counted
+    in power-of-two buckets of microseconds. Safe to update from several threads.
+    '''
+
+    STAGES = ['list', 'read', 'parse', 'rename']
+    COUNTERS = ['seen', 'skipped', 'renamed', 'collisions']
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__start = clock.perf_counter()
+        self.__counters = dict.fromkeys(self.COUNTERS, 0)
+        self.__totals = dict.fromkeys(self.STAGES, 0.0)  # stage -> total time in seconds
+        self.__histograms = {stage: [0] * 40 for stage in self.STAGES}
+
+    def count(self, counter, n=1):
+        ''' Add 'n' to 'counter'. '''
+        with self.__lock:
+            self.__counters[counter] += n
+
+    def record(self, stage, seconds):
+        ''' Add a latency of 'seconds' to 'stage'. '''
+        bucket = min(int(seconds * 1e6).bit_length(), 39)  # latency < 2^bucket us
+        with self.__lock:
+            self.__totals[stage] += seconds
+            self.__histograms[stage][bucket] += 1
+
+    def timed(self, iterable, stage):
+        ''' Yield items of 'iterable', recording the time taken to produce each of them. '''
+        iterator = iter(iterable)
+        while True:
+            start = clock.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(stage, clock.perf_counter() - start)
+            yield item
+
+    def to_dict(self):
+        ''' Return counters, stage latencies and throughput (files seen per second). '''
+        elapsed = clock.perf_counter() - self.__start
+        with self.__lock:
+            stages = dict()
+            for stage in self.STAGES:
+                histogram = self.__histograms[stage]
+                stages[stage] = {'count': sum(histogram),
+                                 'total_s': round(self.__totals[stage], 6),
+                                 'histogram_us': {'<' + str(1 << bucket): n
+                                                  for bucket, n in enumerate(histogram) if n}}
+            return {'counters': dict(self.__counters),
+                    'stages': stages,
+                    'elapsed_s': round(elapsed, 6),
+                    'files_per_s': round(self.__counters['seen'] / elapsed, 3) if elapsed else 0}
+
+class TimedFile:
+    '''
+    Binary file wrapper adding up the time spent in read and seek calls.
+    '''
+
+    def __init__(self, f):
+        self.__f = f
+        self.elapsed = 0.0  # time spent reading in seconds
+
+    def read(self, size=-1):
+        start = clock.perf_counter()
+        data = self.__f.read(size)
+        self.elapsed += clock.perf_counter() - start
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        start = clock.perf_counter()
+        pos = self.__f.seek(offset, whence)
+        self.elapsed += clock.perf_counter() - start
+        return pos
+
+    def tell(self):
+        return self.__f.tell()
+
+    def fileno(self):
+        return self.__f.fileno()
+
+class ExifCache:
+    '''
+    On-disk index of creation times keyed by file identity (device, inode, size, mtime).
+    The inode is used instead of the path so that entries stay valid after a file is renamed.
+    '''
+
+    def __init__(self, name):
+        '''
+        Args:
+            name: path to the sqlite database (created if missing)
+        '''
+
+        import sqlite3
+
+        folder = os.path.dirname(name)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # shared by the reader threads of read_creation_times_async()
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(name, check_same_thread=False)
+        if self.__db.execute('PRAGMA user_version').fetchone()[0] < 1:
+            # times cached before fractions of a second were read
+            self.__db.execute('DROP TABLE IF EXISTS times')
+            self.__db.execute('PRAGMA user_version = 1')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS times (dev INTEGER, ino INTEGER, '
+                          'size INTEGER, mtime INTEGER, time TEXT, PRIMARY KEY (dev, ino))')
+        self.__db.commit()
+        self.__uncommitted = 0  # entries stored since the last commit
+        self.__committed = clock.monotonic()  # time of the last commit
+
+    def get(self, st):
+        ''' Return cached creation time for file status 'st' or None if missing or outdated. '''
+        with self.__lock:
+            row = self.__db.execute('SELECT time FROM times WHERE dev=? AND ino=? AND size=? AND mtime=?',
+                                    (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, st, time):
+        ''' Store creation time for file status 'st'. '''
+        with self.__lock:
+            self.__db.execute('INSERT OR REPLACE INTO times VALUES (?, ?, ?, ?, ?)',
+                              (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, time))
+            self.__uncommitted += 1
+            if (self.__uncommitted >= CACHE_COMMIT_SIZE or
+                    clock.monotonic() - self.__committed >= CACHE_COMMIT_INTERVAL):
+                self.__db.commit()
+                self.__uncommitted = 0
+                self.__committed = clock.monotonic()
+
+    def close(self):
+        ''' Save all changes and close the database. '''
+        self.__db.commit()
+        self.__db.close()
+
+class RenameJournal:
+    '''
+    Append-only log of planned and completed renames, stored as one json record per line:
+        {"op": "plan" | "done" | "undo", "src": old path, "dst": new path}
+    A rename is recorded as planned before it is applied and as done right after, so an
+    interrupted run can be resumed or rolled back without reading any exif data again.
+    '''
+
+    def __init__(self, name):
+        '''
+        Args:
+            name: path to the journal file (created if missing)
+        '''
+
+        self.pending = dict()  # planned renames not completed yet (src -> dst)
+        self.done = dict()  # completed renames in the order they were applied ((src, dst) -> None)
+        if os.path.isfile(name):
+            with open(name) as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # ignore a record cut short by a crash
+                    self.__load(record['op'], record['src'], record['dst'])
+        self.__file = open(name, 'a')
+
+    def __load(self, op, src, dst):
+        if op == 'plan':
+            self.pending[src] = dst
+        elif op == 'done':
+            self.pending.pop(src, None)
+            self.done[(src, dst)] = None
+        elif op == 'undo':
+            self.done.pop((src, dst), None)
+
+    def __write(self, op, src, dst):
+        # flush every record so that it survives the process being killed
+        self.__file.write(json.dumps({'op': op, 'src': src, 'dst': dst}) + '\n')
+        self.__file.flush()
+        self.__load(op, src, dst)
+
+    def plan(self, src, dst):
+        ''' Record that 'src' is about to be renamed to 'dst'. '''
+        self.__write('plan', os.path.abspath(src), os.path.abspath(dst))
+
+    def complete(self, src, dst):
+        ''' Record that 'src' was renamed to 'dst'. '''
+        self.__write('done', os.path.abspath(src), os.path.abspath(dst))
+
+    def revert(self, src, dst):
+        ''' Record that the rename of 'src' to 'dst' was undone. '''
+        self.__write('undo', os.path.abspath(src), os.path.abspath(dst))
+
+    def close(self):
+        ''' Write all records to disk and close the journal. '''
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__file.close()
+
+def undo_renames(journal):
+    '''
+    Undo all completed renames recorded in a journal, most recent first.
+    Args:
+        journal: RenameJournal
+    '''
+
+    for src, dst in reversed(list(journal.done)):
+        if not os.path.isfile(dst) or os.path.exists(src):
+            print ('\nunable to restore "' + src + '" from "' + dst + '"...skipping\n')
+            continue
+        print ('renaming ' + dst + '\tto\t' + os.path.basename(src))
+        try:
+            rename_noreplace(dst, src)
+        except FileExistsError:
+            print ('\nunable to restore "' + src + '", file already exists...skipping\n')
+            continue
+        journal.revert(src, dst)
+
+def register_extractor(*ftypes):
+    '''
+    Decorator registering a creation time extractor for the given file extensions. Extractors
+    take a binary file object and return the creation time as yyyy:mm:dd hh:mm:ss or None; they
+    are tried in the order they were registered until one of them finds the creation time.
+    Args:
+        ftypes: file extensions (lower case)
+    '''
+
+    def register(extractor):
+        for ftype in ftypes:
+            EXTRACTORS.setdefault(ftype, []).append(extractor)
+        return extractor
+    return register
+
+def get_container_type(header):
+    '''
+    Return file extension of the container format identified by the first bytes of a file,
+    or None if not recognized.
+    Args:
+        header: first 16 bytes of the file
+    '''
+
+    if header[:2] == b'\xff\xd8':
+        return 'jpg'
+    if header[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'dng'  # any tiff based raw format
+    if header[4:8] == b'ftyp':
+        brand = header[8:12]
+        if brand in (b'heic', b'heix', b'mif1', b'msf1'):
+            return 'heic'
+        if brand == b'crx ':
+            return 'cr3'
+        return 'mp4'
+    return None
+
+def add_subsec(time, subsec):
+    '''
+    Return creation time 'time' with the fraction of a second 'subsec' (exif SubSecTimeOriginal,
+    digits only) appended as yyyy:mm:dd hh:mm:ss.sss; 'time' is returned unchanged if 'subsec'
+    is missing or invalid.
+    '''
+
+    subsec = (subsec or '').strip()
+    return time + '.' + subsec.ljust(3, '0') if subsec.isdigit() else time
+
+def read_tiff_time(f, base=0, exif_ifd=False):
+    '''
+    Return DateTimeOriginal (with SubSecTimeOriginal if present) of the tiff structure at offset
+    'base' of file 'f' or None. Only IFD0 and the exif IFD are read.
+    Args:
+        f:        binary file object
+        base:     offset of the tiff header (optional)
+        exif_ifd: IFD0 is the exif IFD itself, as in canon cr3 files (optional)
+    '''
+
+    def read_ifd(ifd):
+        # return {tag: (type, count, value or offset)} of the IFD at offset 'ifd'
+        f.seek(base + ifd)
+        data = f.read(2)
+        if len(data) < 2:
+            return dict()
+        data = f.read(12 * struct.unpack(order + 'H', data)[0])
+        entries = dict()
+        for pos in range(0, len(data) - 11, 12):
+            tag, kind, count = struct.unpack_from(order + 'HHI', data, pos)
+            entries[tag] = (kind, count, data[pos+8:pos+12])
+        return entries
+
+    def read_ascii(entry):
+        # return value of an ascii entry or None
+        if entry is None or entry[0] != 2:
+            return None
+        if entry[1] <= 4:
+            value = entry[2][:entry[1]]
+        else:
+            f.seek(base + struct.unpack(order + 'I', entry[2])[0])
+            value = f.read(entry[1])
+        return value.split(b'\x00')[0].decode('ascii', 'replace').strip()
+
+    f.seek(base)
+    header = f.read(8)
+    if header[:4] == b'II*\x00':
+        order = '<'
+    elif header[:4] == b'MM\x00*':
+        order = '>'
+    else:
+        return None
+    ifd = struct.unpack(order + 'I', header[4:8])[0]
+
+    # locate exif IFD
+    if not exif_ifd:
+        entry = read_ifd(ifd).get(0x8769)
+        if entry is None:
+            return None
+        ifd = struct.unpack(order + 'I', entry[2])[0]
+
+    # read DateTimeOriginal and SubSecTimeOriginal
+    entries = read_ifd(ifd)
+    time = read_ascii(entries.get(0x9003))
+    if time is None or not TIME_PATTERN.fullmatch(time):
+        return None
+    return add_subsec(time, read_ascii(entries.get(0x9291)))
+
+def iter_boxes(f, start, end):
+    '''
+    Yield (type, payload start, payload end) of the iso base media file format boxes found
+    between offsets 'start' and 'end' of file 'f'. Box payloads are skipped, not read.
+    '''
+
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack('>I4s', header)
+        offset = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            offset = 16
+        elif size == 0:
+            size = end - pos  # box extends to the end
+        if size < offset:
+            return
+        yield kind, pos + offset, min(pos + size, end)
+        pos += size
+
+def find_box(f, start, end, *path):
+    ''' Return (payload start, payload end) of the first box found along 'path' or None. '''
+
+    for kind in path:
+        for box in iter_boxes(f, start, end):
+            if box[0] == kind:
+                start, end = box[1], box[2]
+                break
+        else:
+            return None
+    return start, end
+
+@register_extractor('jpg', 'jpeg')
+def read_jpeg_time(f):
+    ''' Return DateTimeOriginal of a jpeg file, reading the segments up to the exif one. '''
+
+    pos = 2
+    while True:
+        f.seek(pos)
+        marker = f.read(4)
+        if len(marker) < 4 or marker[0] != 0xff or marker[1] in (0xd9, 0xda):
+            return None  # end of file or start of image data
+        if marker[1] == 0xe1 and f.read(6) == b'Exif\x00\x00':
+            return read_tiff_time(f, pos + 10)
+        pos += 2 + struct.unpack('>H', marker[2:])[0]
+
+@register_extractor('nef', 'nrw', 'dng', 'cr2', 'arw')
+def read_raw_time(f):
+    ''' Return DateTimeOriginal of a tiff based raw file. '''
+    return read_tiff_time(f)
+
+@register_extractor('cr3')
+def read_cr3_time(f):
+    ''' Return DateTimeOriginal of a canon cr3 file, stored as tiff in moov/uuid/CMT2. '''
+
+    end = os.fstat(f.fileno()).st_size
+    moov = find_box(f, 0, end, b'moov')
+    if moov is None:
+        return None
+    for kind, start, stop in iter_boxes(f, *moov):
+        f.seek(start)
+        if kind == b'uuid' and f.read(16) == CR3_UUID:
+            box = find_box(f, start + 16, stop, b'CMT2')
+            return read_tiff_time(f, box[0], True) if box is not None else None
+    return None
+
+@register_extractor('heic', 'heif')
+def read_heic_time(f):
+    ''' Return DateTimeOriginal of a heic file, stored as tiff in the 'Exif' item. '''
+
+    end = os.fstat(f.fileno()).st_size
+    meta = find_box(f, 0, end, b'meta')
+    if meta is None:
+        return None
+    meta = (meta[0] + 4, meta[1])  # skip version and flags
+
+    # find id of exif item
+    iinf = find_box(f, meta[0], meta[1], b'iinf')
+    if iinf is None:
+        return None
+    f.seek(iinf[0])
+    version = f.read(4)[0]
+    item = None
+    for kind, start, stop in iter_boxes(f, iinf[0] + (6 if version == 0 else 8), iinf[1]):
+        f.seek(start)
+        data = f.read(14)
+        if kind != b'infe' or data[0] < 2:
+            continue
+        if data[0] == 2:
+            item_id, item_type = struct.unpack('>H', data[4:6])[0], data[8:12]
+        else:
+            item_id, item_type = struct.unpack('>I', data[4:8])[0], data[10:14]
+        if item_type == b'Exif':
+            item = item_id
+            break
+    if item is None:
+        return None
+
+    # find location of exif item
+    iloc = find_box(f, meta[0], meta[1], b'iloc')
+    if iloc is None:
+        return None
+    f.seek(iloc[0])
+    data = f.read(iloc[1] - iloc[0])
+    version = data[0]
+    offset_size, length_size = data[4] >> 4, data[4] & 15
+    base_size, index_size = data[5] >> 4, (data[5] & 15 if version in (1, 2) else 0)
+    id_size = 2 if version < 2 else 4
+
+    def read_int(pos, size):
+        return (int.from_bytes(data[pos:pos+size], 'big') if size else 0), pos + size
+
+    count, pos = read_int(6, id_size)
+    for i in range(count):
+        item_id, pos = read_int(pos, id_size)
+        method = 0
+        if version in (1, 2):
+            method, pos = read_int(pos, 2)
+        pos += 2  # data reference index
+        base, pos = read_int(pos, base_size)
+        extents, pos = read_int(pos, 2)
+        offset = None
+        for j in range(extents):
+            pos += index_size
+            extent, pos = read_int(pos, offset_size)
+            pos += length_size
+            if offset is None:
+                offset = base + extent
+        if item_id == item and offset is not None and method & 15 == 0:  # offset in file
+            # item starts with the offset of the tiff header
+            f.seek(offset)
+            return read_tiff_time(f, offset + 4 + struct.unpack('>I', f.read(4))[0])
+    return None
+
+@register_extractor('mp4', 'mov')
+def read_video_time(f):
+    '''
+    Return creation time of a quicktime / mp4 video stored in moov/mvhd. Unlike exif times,
+    video creation times are stored in UTC; they are converted to local time, so videos sort
+    in between the photos taken around them.
+    '''
+
+    end = os.fstat(f.fileno()).st_size
+    mvhd = find_box(f, 0, end, b'moov', b'mvhd')
+    if mvhd is None:
+        return None
+    f.seek(mvhd[0])
+    data = f.read(12)
+    seconds = struct.unpack('>Q', data[4:12])[0] if data[0] == 1 else struct.unpack('>I', data[4:8])[0]
+    if seconds == 0:
+        return None
+    return clock.strftime('%Y:%m:%d %H:%M:%S', clock.localtime(seconds - MAC_EPOCH))
+
+@register_extractor('nef', 'nrw', 'dng', 'cr2', 'arw', 'jpg', 'jpeg', 'heic', 'heif')
+def read_exifread_time(f):
+    '''
+    Return DateTimeOriginal (with SubSecTimeOriginal if present) parsed by exifread; fallback for
+    files the built-in parsers can't handle. Only the tags up to 'SubSecTimeOriginal' are parsed;
+    maker notes and thumbnails are skipped so just the header of large raw files has to be read.
+    '''
+
+    import exifread
+
+    f.seek(0)
+    try:
+        data = exifread.process_file(f, details=False, stop_tag='SubSecTimeOriginal')
+    except Exception:  # exifread raises its own errors (e.g. EOFError, BadSize) on truncated files
+        return None
+    time = str(data.get('EXIF DateTimeOriginal', '')).strip()
+    if not TIME_PATTERN.fullmatch(time):
+        return None  # missing or cut off
+    subsec = data.get('EXIF SubSecTimeOriginal')
+    return add_subsec(time, str(subsec) if subsec else None)
+
+def get_creation_time(file, stats=None):
+    '''
+    Return the creation time stored in the file metadata or None if not available.
+    The extractors are picked by the container format found in the first bytes of the file, so
+    files with a misleading extension are still handled, or by the file extension otherwise.
+    Args:
+        file:  path to photo
+        stats: RunStats to record the time spent reading and parsing in (optional)
+    '''
+
+    start = clock.perf_counter()
+    time = None
+    with open(file, 'rb') as f:
+        opened = clock.perf_counter()
+        photo = f if stats is None else TimedFile(f)
+        ftype = get_container_type(photo.read(16))
+        if ftype is None:
+            ftype = file.split('.')[-1].lower()
+        for extractor in EXTRACTORS.get(ftype, []):
+            try:
+                time = extractor(photo)
+            except (OSError, ValueError, IndexError, struct.error):
+                continue  # truncated or corrupted metadata
+            if time is not None:
+                break
+    if stats is not None:
+        read = opened - start + photo.elapsed
+        stats.record('read', read)
+        stats.record('parse', clock.perf_counter() - start - read)
+    return time
+
+def is_photo(name):
+    ''' Return True if file 'name' is not hidden and has a valid file extension. '''
+    return not name.startswith('.') and name.split('.')[-1].lower() in EXTRACTORS
+
+def is_sidecar(name):
+    ''' Return True if file 'name' is not hidden and has a sidecar file extension. '''
+    return not name.startswith('.') and name.split('.')[-1].lower() in SIDECARS
+
+def get_read_cost(file):
+    ''' Return sort key ranking photos by how cheap it is to read their creation time. '''
+    ftype = file.split('.')[-1].lower()
+    return READ_ORDER.index(ftype) if ftype in READ_ORDER else len(READ_ORDER)
+
+def group_files(files):
+    '''
+    Yield lists of files sharing the folder and the name up to the first dot, e.g. raw file,
+    jpeg and xmp sidecar (DSC_0001.NEF.xmp or DSC_0001.xmp) of the same shot. Files are expected
+    folder by folder, as yielded by scan_photos(), and are grouped one folder at a time.
+    Args:
+        files: iterable of paths
+    '''
+
+    folder = None
+    groups = OrderedDict()  # name up to the first dot -> files
+    for file in files:
+        if os.path.dirname(file) != folder:
+            yield from groups.values()
+            folder = os.path.dirname(file)
+            groups = OrderedDict()
+        groups.setdefault(os.path.basename(file).split('.')[0], []).append(file)
+    yield from groups.values()
+
+def get_group_files(file):
+    ''' Return photo 'file' followed by the other files of its group (see group_files()). '''
+
+    folder, name = os.path.split(file)
+    return [file] + [os.path.join(folder, other) for other in sorted(os.listdir(folder or '.'))
+                     if other != name and other.split('.')[0] == name.split('.')[0] and
+                     (is_photo(other) or is_sidecar(other))]
+
+def scan_photos(path, recursive=False, sidecars=False, stats=None):
+    '''
+    Yield paths of all photos in a folder without building a listing of the whole tree.
+    Each folder is read completely before its photos are yielded, so renaming files while the
+    generator is running can't make them show up a second time.
+    Args:
+        path:      folder to scan
+        recursive: also scan all sub-folders (optional)
+        sidecars:  also yield sidecar files (optional)
+        stats:     RunStats to count the files that are not yielded as seen and skipped in
+                   (optional)
+    '''
+
+    folders = [path]
+    while folders:
+        with os.scandir(folders.pop()) as it:
+            entries = list(it)
+        for entry in entries:
+            # file type info is cached by scandir, so no extra stat is needed
+            if recursive and entry.is_dir(follow_symlinks=False):
+                if not entry.name.startswith('.'):
+                    folders.append(entry.path)
+            elif entry.is_file() and (is_photo(entry.name) or sidecars and is_sidecar(entry.name)):
+                yield entry.path
+            else:
+                print ('\n"' + entry.path + '" is not a valid file...skipping\n')
+                if stats is not None:
+                    stats.count('seen')
+                    stats.count('skipped')
+
+def watch_photos(path, interval=1.0, stats=None):
+    '''
+    Yield paths of photos already in a folder, then of every new photo as soon as it has been
+    completely written. Runs until interrupted. Uses inotify where available and falls back to
+    polling the folder, in which case a photo is new once its size and modification time stay
+    the same between two polls.
+    Args:
+        path:     folder to watch
+        interval: time between polls in seconds (optional)
+        stats:    RunStats passed to scan_photos() (optional)
+    '''
+
+    fd = inotify_init1(IN_CLOEXEC) if inotify_init1 is not None else -1
+    if fd >= 0 and inotify_add_watch(fd, os.fsencode(path),
+                                     IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO) < 0:
+        os.close(fd)
+        fd = -1
+
+    # polling fallback
+    if fd < 0:
+        seen = None  # name -> (size, modification time) at last poll
+        done = set()  # photos already yielded
+        while True:
+            current = dict()
+            with os.scandir(path) as it:
+                for entry in it:
+                    if is_photo(entry.name) and entry.name not in done and entry.is_file():
+                        st = entry.stat()
+                        current[entry.name] = (st.st_size, st.st_mtime_ns)
+            for name, info in current.items():
+                if seen is None or seen.get(name) == info:
+                    done.add(name)
+                    yield os.path.join(path, name)
+            seen = current
+            clock.sleep(interval)
+
+    # photos present before the watch started; any of them reported again below is skipped
+    # once it has been renamed
+    try:
+        yield from scan_photos(path, stats=stats)
+        moved = dict()  # cookie -> name of photos moved within the folder (e.g. renamed by us)
+        while True:
+            data = os.read(fd, 65536)
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, size = struct.unpack_from('iIII', data, pos)
+                name = os.fsdecode(data[pos+16:pos+16+size].rstrip(b'\0'))
+                pos += 16 + size
+                if mask & IN_Q_OVERFLOW:
+                    yield from scan_photos(path, stats=stats)
+                elif mask & IN_MOVED_FROM:
+                    moved[cookie] = name
+                elif mask & IN_MOVED_TO and is_photo(moved.pop(cookie, '')):
+                    continue  # photo renamed in place
+                elif is_photo(name) and os.path.isfile(os.path.join(path, name)):
+                    yield os.path.join(path, name)
+    finally:
+        os.close(fd)
+
+def get_disk_offset(file):
+    '''
+    Return a key that sorts files by their location on disk: the physical offset of the first
+    extent where the file system reports it (fiemap), otherwise the inode number.
+    Args:
+        file: path to file
+    '''
+
+    try:
+        import fcntl
+    except ImportError:  # not a posix system
+        return (1, os.stat(file).st_ino)
+    try:
+        with open(file, 'rb') as f:
+            # struct fiemap followed by space for one struct fiemap_extent
+            request = struct.pack('QQIIII', 0, 0xFFFFFFFFFFFFFFFF, FIEMAP_FLAG_SYNC, 0, 1, 0)
+            result = fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request + bytes(56))
+            if struct.unpack_from('I', result, 20)[0] > 0:  # number of mapped extents
+                return (0, struct.unpack_from('Q', result, 40)[0])  # physical offset
+            return (1, os.fstat(f.fileno()).st_ino)
+    except OSError:
+        return (1, os.stat(file).st_ino)
+
+def schedule_reads(files, batch=4096):
+    '''
+    Yield files in batches sorted by their location on disk, to avoid random seeks when their
+    headers are read from spinning disks.
+    Args:
+        files: iterable of paths
+        batch: number of files sorted at once (optional)
+    '''
+
+    pending = []
+    for file in files:
+        pending.append(file)
+        if len(pending) == batch:
+            yield from sorted(pending, key=get_disk_offset)
+            pending = []
+    yield from sorted(pending, key=get_disk_offset)
+
+def prefetch_files(files, depth=64):
+    '''
+    Yield files while asking the kernel to read the headers of the next 'depth' files in the
+    background (posix_fadvise WILLNEED), so the disk is busy while earlier files are parsed.
+    Args:
+        files: iterable of paths
+        depth: number of files prefetched ahead (optional)
+    '''
+
+    pending = deque()
+    for file in files:
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                fd = os.open(file, os.O_RDONLY)
+                os.posix_fadvise(fd, 0, PREFETCH_SIZE, os.POSIX_FADV_WILLNEED)
+                os.close(fd)
+            except OSError:
+                pass
+        pending.append(file)
+        if len(pending) > depth:
+            yield pending.popleft()
+    yield from pending
+
+def read_creation_times(files, jobs=1, cache=None, ahead=None, stats=None):
+    '''
+    Yield (file, creation time) pairs in the order of 'files', reading up to 'jobs' files in
+    parallel. Only a few reads per job are queued ahead, so 'files' can be a generator of any size.
+    Args:
+        files: iterable of photo paths
+        jobs:  number of files to read in parallel (optional)
+        cache: ExifCache used to skip reading unchanged files (optional)
+        ahead: number of files queued ahead of the results (optional, default: 4 per job)
+        stats: RunStats to record read and parse times in (optional)
+    '''
+
+    if ahead is None:
+        ahead = 4 * jobs
+
+    # read a single file in the calling thread, e.g. from server mode or with -f
+    if jobs == 1 and ahead == 0:
+        for file in files:
+            st = os.stat(file) if cache is not None else None
+            time = cache.get(st) if cache is not None else None
+            if time is None:
+                time = get_creation_time(file, stats)
+                if cache is not None and time is not None:
+                    cache.put(st, time)
+            yield file, time
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    def result(file, st, time):
+        # wait for exif data and update cache
+        if not isinstance(time, str):
+            time = time.result()
+            if cache is not None and time is not None:
+                cache.put(st, time)
+        return file, time
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        for file in files:
+            st = os.stat(file) if cache is not None else None
+            time = cache.get(st) if cache is not None else None
+            if time is None:
+                time = pool.submit(get_creation_time, file, stats)
+            pending.append((file, st, time))
+            if len(pending) > ahead:
+                yield result(*pending.popleft())
+        while pending:
+            yield result(*pending.popleft())
+
+def read_creation_times_async(files, jobs=1, cache=None, ahead=None, stats=None):
+    '''
+    Same as read_creation_times(), but run as an asyncio pipeline on a background event loop:
+    a lister task pulls paths from 'files' and hands them to 'jobs' reader tasks through a
+    bounded queue, the readers extract exif data in worker threads and the caller consumes the
+    results one at a time as the single committer. Results finishing out of order are held back
+    until all earlier ones are done, and at most 'ahead' + 1 files are in flight at any time.
+    Args:
+        files: iterable of photo paths
+        jobs:  number of reader tasks (optional)
+        cache: ExifCache used to skip reading unchanged files (optional)
+        ahead: number of files queued ahead of the results (optional, default: 4 per job)
+        stats: RunStats to record read and parse times in (optional)
+    '''
+
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    if ahead is None:
+        ahead = 4 * jobs
+    results = queue.Queue()  # (index, file, time), exception or None when done
+    loop = asyncio.new_event_loop()
+    # one thread lists files, the others read them
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=jobs + 1))
+    window = asyncio.Semaphore(ahead + 1)  # released by the committer
+
+    def read(file):
+        st = os.stat(file) if cache is not None else None
+        time = cache.get(st) if cache is not None else None
+        if time is None:
+            time = get_creation_time(file, stats)
+            if cache is not None and time is not None:
+                cache.put(st, time)
+        return time
+
+    async def lister(listed):
+        iterator = iter(files)
+        index = 0
+        while True:
+            await window.acquire()
+            # listing may block on disk or in watch mode, keep it off the event loop
+            file = await asyncio.to_thread(next, iterator, None)
+            if file is None:
+                break
+            await listed.put((index, file))
+            index += 1
+        for i in range(jobs):
+            await listed.put(None)
+
+    async def reader(listed):
+        while (item := await listed.get()) is not None:
+            index, file = item
+            results.put((index, file, await asyncio.to_thread(read, file)))
+
+    async def pipeline():
+        listed = asyncio.Queue(maxsize=jobs)
+        try:
+            await asyncio.gather(lister(listed), *(reader(listed) for i in range(jobs)))
+            results.put(None)
+        except asyncio.CancelledError:
+            pass  # committer stopped early
+        except Exception as error:
+            results.put(error)
+
+    task = loop.create_task(pipeline())
+    def run():
+        try:
+            loop.run_until_complete(task)
+        finally:
+            loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        done = dict()  # results waiting for an earlier file
+        index = 0
+        while True:
+            while index not in done:
+                item = results.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                done[item[0]] = item[1:]
+            yield done.pop(index)
+            index += 1
+            try:
+                loop.call_soon_threadsafe(window.release)
+            except RuntimeError:
+                pass  # all files listed and loop closed
+    finally:
+        # stop reading ahead if the committer gives up early
+        if thread.is_alive():
+            try:
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                pass  # loop closed in the meantime
+        thread.join()
+
+def get_base_name(time, subsec=False):
+    '''
+    Return name yyyymmdd_hhmmss for creation time 'time' (yyyy:mm:dd hh:mm:ss(.sss)).
+    Args:
+        time:   creation time
+        subsec: append the fraction of a second as yyyymmdd_hhmmss-sss if available (optional)
+    '''
+
+    time, _, fraction = time.partition('.')
+    name = time.replace(' ', '_').replace(':', '')
+    return name + '-' + fraction if subsec and fraction else name
+
+def plan_renames(files, jobs=1, cache=None, names=None, ahead=None, tree=None, into=None,
+                 dedup=False, group=False, stats=None, skip_named=False, verify=0.0, subsec=False,
+                 reader=read_creation_times):
+    '''
+    Yield a list of RenameStep for every photo that needs a new name, without renaming anything.
+    The plan is generated lazily, so it can be applied while later photos are still being read.
+    Files renamed under a shared name (see 'group') are yielded together in one list, so each
+    group can be applied as soon as it is planned.
+    Args:
+        files: iterable of photo paths
+        jobs:  number of files to read exif metadata from in parallel (optional)
+        cache: ExifCache used to skip reading unchanged files (optional)
+        names: NameIndex to share with apply_plan() (optional)
+        ahead: number of files read ahead of the plan (optional, default: 4 per job)
+        tree:  move photos to sub-folders yyyy/mm/dd of this folder instead of renaming them in
+               place (optional)
+        into:  move photos to this folder instead of renaming them in place (optional)
+        dedup: check photos against files in the target folder with the same creation time and
+               return steps with the identical file set as duplicate (optional; single files
+               only, groups are never checked)
+        group: rename files grouped by group_files() under a shared name, reading the creation
+               time only from the cheapest photo of each group (optional)
+        stats: RunStats to record file counts and listing, read and parse times in (optional)
+        skip_named: skip files already named yyyymmdd_hhmmss(_cc).ext without reading them
+                    (optional)
+        verify:     fraction of the skipped files that is still read, to check their names
+                    against the creation time; files with a wrong name are renamed (optional)
+        subsec:     name photos yyyymmdd_hhmmss-sss using the fraction of a second of the
+                    creation time, so photos of a burst get distinct names without depending on
+                    the order they are processed in; duplicate counters are only used for photos
+                    without it or with the same fraction (optional)
+        reader:     function reading the creation times, read_creation_times() or
+                    read_creation_times_async() (optional)
+    '''
+
+    if names is None:
+        names = NameIndex()
+    checksums = dict()  # checksums of duplicate candidates
+    planned = dict()  # new path -> old path of single files planned for dedup
+
+    # select the photo to read the creation time from
+    groups = deque()  # groups waiting for the creation time of their photo
+    def select(files):
+        if stats is not None:
+            files = stats.timed(files, 'list')
+        for members in (group_files(files) if group else ([file] for file in files)):
+            if stats is not None:
+                stats.count('seen', len(members))
+
+            # files whose extensions only differ in case would get the same new name
+            ftypes = dict()  # file extension -> file
+            for file in list(members):
+                ftype = os.path.basename(file).split('.', 1)[-1].lower()
+                if ftype in ftypes:
+                    print ('\n"' + file + '" has the same file extension as "' + ftypes[ftype] +
+                           '"...skipping\n')
+                    if stats is not None:
+                        stats.count('skipped')
+                    members.remove(file)
+                else:
+                    ftypes[ftype] = file
+            photos = [file for file in members if is_photo(os.path.basename(file))]
+            if not photos:
+                print ('\nno photo found for "' + members[0] + '"...skipping\n')
+                if stats is not None:
+                    stats.count('skipped', len(members))
+                continue
+
+            # skip files named by an earlier run unless picked for verification
+            named = skip_named and all(NAME_PATTERN.fullmatch(os.path.basename(file))
+                                       for file in members)
+            if named and random.random() >= verify:
+                if stats is not None:
+                    stats.count('skipped', len(members))
+                continue
+            groups.append((members, named))
+            yield min(photos, key=get_read_cost)
+
+    # exif data is read ahead in parallel but returned in the original order,
+    # so duplicate counters don't depend on which read finishes first
+    for file, time in reader(select(files), jobs, cache, ahead, stats):
+        members, named = groups.popleft()
+        folder = os.path.dirname(file)
+        if group:
+            ftypes = [os.path.basename(f).split('.', 1)[1].lower() for f in members]
+        else:
+            ftypes = [file.split('.')[-1].lower()]
+
+        # skip if file creation time not found
+        if time is None:
+            print ('\nunable to extract creation time from "' + file + '"...skipping\n')
+            if stats is not None:
+                stats.count('skipped', len(members))
+            continue
+
+        # select target folder
+        target = folder if into is None else into
+        if tree is not None:
+            target = os.path.join(tree, time[0:4], time[5:7], time[8:10])
+            if os.path.normpath(target) == os.path.normpath(folder):
+                target = folder
+
+        # construct new name as: yyyymmdd_hhmmss(_cc)
+        current = [os.path.basename(f) for f in members]
+        base = get_base_name(time, subsec)
+        new = names.allocate_group(target, base, ftypes,
+                                   current if target == folder else None)
+        if new == current and target == folder:
+            if stats is not None:
+                stats.count('skipped', len(members))
+            continue
+        if named:
+            print ('\nname of "' + file + '" doesn\'t match its creation time\n')
+        if stats is not None and not new[0].startswith(base + '.'):
+            stats.count('collisions')  # needed a duplicate counter
+
+        # look for identical file among the ones with the same creation time
+        if dedup and len(members) == 1:
+            candidates = []
+            for other in sorted(names.group(target, base)):
+                if other != new[0] and other.endswith('.' + ftypes[0]):
+                    # files planned earlier may not be renamed yet (e.g. in a dry run)
+                    candidate = os.path.join(target, other)
+                    if candidate in planned and os.path.exists(planned[candidate]):
+                        candidate = planned[candidate]
+                    candidates.append(candidate)
+            duplicate = find_duplicate(file, candidates, checksums)
+            if duplicate is not None:
+                if stats is not None:
+                    stats.count('skipped')
+                names.release(target, new[0])
+                yield [RenameStep(file, None, time, duplicate, base)]
+                continue
+
+        steps = []
+        for f, name in zip(members, new):
+            if into is None:
+                names.release(folder, os.path.basename(f))
+            if dedup and len(members) == 1:
+                planned[os.path.join(target, name)] = f
+            steps.append(RenameStep(f, os.path.join(target, name), time, None, base))
+        yield steps
+
+def apply_plan(plan, names=None, journal=None, copy=False, dedup='skip', stats=None,
+               renamed=None):
+    '''
+    Rename files according to a plan and return the number of renamed files. Files sharing a
+    new name (e.g. raw file, jpeg and sidecar of the same shot) are renamed together: if one of
+    them can't be renamed, the others are reverted and all of them get the next free name.
+    Missing target folders are created.
+    Args:
+        plan:    iterable of lists of RenameStep, one list per group of files renamed together
+        names:   NameIndex used to pick another name if the planned one was taken meanwhile
+                 (optional; such files are skipped otherwise)
+        journal: RenameJournal to record the renames in (optional)
+        copy:    copy files to their new names instead, verifying each copy against the original
+                 by checksum (optional)
+        dedup:   action for files identical to an existing one: 'skip' leaves them untouched,
+                 'link' replaces them by a hard link to the existing file and 'delete' removes
+                 them; duplicates are never copied (optional)
+        stats:   RunStats to record renamed files, collisions and rename times in (optional)
+        renamed: list to append (old path, new path) of every renamed or copied file to
+                 (optional)
+    '''
+
+    def transfer(src, dst):
+        # rename or copy file; returns False if the copy is corrupted
+        src_fd = folders.open(os.path.dirname(src))
+        dst_fd = folders.open(os.path.dirname(dst))
+        if not copy:
+            rename_noreplace(os.path.basename(src), os.path.basename(dst), src_fd, dst_fd)
+            return True
+        copy_noreplace(src, os.path.basename(dst), dst_fd)
+
+        # the source is still in the page cache after the copy, the copy is read back from disk
+        if get_checksum(src) != get_checksum(os.path.basename(dst), dst_fd, False):
+            os.unlink(os.path.basename(dst), dir_fd=dst_fd)
+            print ('\ncopy of "' + src + '" is corrupted...skipping\n')
+            return False
+        return True
+
+    def revert(src, dst):
+        # undo transfer of a file
+        if copy:
+            os.unlink(dst)
+        else:
+            rename_noreplace(dst, src)
+
+    count = 0
+    folders = FolderCache()
+    for steps in plan:
+        # identical file already on disk
+        if steps[0].duplicate is not None:
+            src, duplicate = steps[0].src, steps[0].duplicate
+            if copy or dedup == 'skip':
+                print ('\n"' + src + '" is a duplicate of "' + duplicate + '"...skipping\n')
+            elif dedup == 'link':
+                print ('linking ' + src + '\tto\t' + duplicate)
+                os.link(duplicate, src + '.link')
+                os.replace(src + '.link', src)
+            elif dedup == 'delete':
+                print ('deleting ' + src + '\t(duplicate of ' + duplicate + ')')
+                os.unlink(src)
+            continue
+
+        dsts = [step.dst for step in steps]
+        retries = 0
+        while dsts is not None:
+            done = []
+            try:
+                for step, dst in zip(steps, dsts):
+                    moved = os.path.dirname(step.src) != os.path.dirname(dst)
+                    print (('copying ' if copy else 'renaming ') + step.src + '\tto\t' +
+                           (dst if moved else os.path.basename(dst)))
+                    if journal is not None:
+                        journal.plan(step.src, dst)
+                    start = clock.perf_counter()
+                    transferred = transfer(step.src, dst)
+                    if stats is not None:
+                        stats.record('rename', clock.perf_counter() - start)
+                    if transferred:
+                        done.append((step.src, dst))
+                break
+            except FileExistsError:
+                if stats is not None:
+                    stats.count('collisions')
+                for reverted in reversed(done):
+                    revert(*reverted)
+                if names is None or retries == MAX_RETRIES:
+                    print ('\n"' + dst + '" already exists...skipping\n')
+                    dsts = None
+                    break
+                retries += 1
+                folder = os.path.dirname(dsts[0])
+                ftypes = [os.path.basename(dst).split('.', 1)[1] for dst in dsts]
+                dsts = [os.path.join(folder, name) for name in
+                        names.allocate_group(folder, steps[0].base, ftypes)]
+                print ('name already taken, picking the next free one')
+        if dsts is not None:
+            count += len(done)
+            if renamed is not None:
+                renamed.extend(done)
+            if stats is not None:
+                stats.count('renamed', len(done))
+            if journal is not None:
+                for src, dst in done:
+                    journal.complete(src, dst)
+    folders.close()
+    return count
+
+def rename_file(file, args, names, cache=None, journal=None, stats=None):
+    '''
+    Rename a single photo, together with the other files of its group if requested, and return
+    its new path, or its old path if it isn't renamed. Used by server mode, where each request
+    is handled as if the photo was passed with -f.
+    Args:
+        file:    path to photo
+        args:    argparse namespace parsed in rename_photos()
+        names:   NameIndex shared by all requests
+        cache:   ExifCache (optional)
+        journal: RenameJournal (optional)
+        stats:   RunStats (optional)
+    '''
+
+    if not os.path.isfile(file) or not is_photo(os.path.basename(file)):
+        print ('\n"' + file + '" is not a valid file...skipping\n')
+        return file
+    files = get_group_files(file) if args.group else [file]
+    tree = os.path.dirname(file) if args.tree == '' else args.tree
+    plan = list(plan_renames(files, jobs=1, cache=cache, names=names, ahead=0, tree=tree,
+                             dedup=args.dedup is not None, group=args.group, stats=stats,
+                             skip_named=args.skip_named, verify=args.verify,
+                             subsec=args.subsec))
+    if args.dry_run:
+        renamed = [(step.src, step.dst) for steps in plan for step in steps
+                   if step.duplicate is None]
+    else:
+        renamed = []
+        apply_plan(plan, names=names, journal=journal, dedup=args.dedup or 'skip', stats=stats,
+                   renamed=renamed)
+    return dict(renamed).get(file, file)
+
+def serve_renames(args, names, cache=None, journal=None, stats=None):
+    '''
+    Rename photos as they are requested until the input ends (stdin) or the server is
+    interrupted (unix socket), without paying for startup and imports on every photo.
+    Requests are photo paths, one per line, and each is answered by a line with the new path
+    (see rename_file()). Requests are handled one at a time, so duplicate counters are the same
+    as if the photos were passed with -f one after the other.
+    Args:
+        args:    argparse namespace parsed in rename_photos(); args.serve is the path of the
+                 unix socket to listen on or '' to read requests from stdin
+        names:   NameIndex shared by all requests
+        cache:   ExifCache (optional)
+        journal: RenameJournal (optional)
+        stats:   RunStats (optional)
+    '''
+
+    def handle(requests, reply):
+        for line in requests:
+            file = line.rstrip('\n')
+            if file:
+                reply(rename_file(file, args, names, cache, journal, stats) + '\n')
+
+    if args.serve == '':
+        # stdout carries the replies, so progress messages go to stderr
+        stdout = sys.stdout
+        def reply(line):
+            stdout.write(line)
+            stdout.flush()
+        sys.stdout = sys.stderr
+        try:
+            handle(sys.stdin, reply)
+        finally:
+            sys.stdout = stdout
+        return
+
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            handle((line.decode() for line in self.rfile),
+                   lambda line: self.wfile.write(line.encode()))
+
+    try:
+        if not stat.S_ISSOCK(os.lstat(args.serve).st_mode):
+            print('\n"' + args.serve + '" already exists and is not a socket\n')
+            return
+        os.unlink(args.serve)  # left over from an earlier server
+    except FileNotFoundError:
+        pass
+    with socketserver.UnixStreamServer(args.serve, Handler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(args.serve)
 
 def rename_photos():
     '''
     Rename photo(s) based on the creation time using the format:
         yyyymmdd_hhmmss(_cc)
     where cc represents a potential duplicate counter (to make sure files don't get overwritten).
-    Acceptable file formats: nef, dng, jpg, jpeg
+    Acceptable file formats: arw, cr2, cr3, dng, heic, heif, jpeg, jpg, mov, mp4, nef, nrw
     '''
 
     # set up command-line options
     info = 'Rename photo(s) based on the creation time using the format yyyymmdd_hhmmss(_cc) \
             where cc represents a potential duplicate counter. \
-            Acceptable file formats: nef, dng, jpg, jpeg'
+            Acceptable file formats: ' + ', '.join(sorted(EXTRACTORS))
     parser = ArgumentParser(description=info, add_help=True)
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('-f', '--file', metavar='name', help='process named file')
     group.add_argument('-p', '--path', metavar='name', help='process files in named location')
+    group.add_argument('-i', '--import-from', metavar='name',
+                       help='copy files from named location (e.g. a memory card) to the location \
+                             given by --into')
+    group.add_argument('-u', '--undo', metavar='name',
+                       help='undo all renames recorded in named journal')
+    group.add_argument('--serve', metavar='name', nargs='?', const='',
+                       help='keep running and rename the photos whose paths are sent to named \
+                             unix socket (default: stdin), one per line; each path is answered \
+                             by a line with the new path')
+    parser.add_argument('--into', metavar='name',
+                        help='location to copy imported files to')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='also process files in all sub-folders of the named location')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='number of files to read exif metadata from in parallel')
+    parser.add_argument('-a', '--asyncio', action='store_true',
+                        help='read exif metadata in an asyncio pipeline of N reader tasks')
+    parser.add_argument('-s', '--skip-named', action='store_true',
+                        help='skip files already named yyyymmdd_hhmmss(_cc) without reading them')
+    parser.add_argument('--verify', metavar='fraction', type=float, default=0.0,
+                        help='with --skip-named, still read this fraction of the skipped files \
+                              and rename them if their name is wrong')
+    parser.add_argument('--subsec', action='store_true',
+                        help='name photos yyyymmdd_hhmmss-sss using the fraction of a second of \
+                              the creation time where available (e.g. for bursts)')
+    parser.add_argument('-o', '--ordered', action='store_true',
+                        help='read files in the order they are stored on disk and prefetch \
+                              their headers (for spinning disks)')
+    parser.add_argument('-c', '--cache', metavar='name', nargs='?', const=CACHE_NAME,
+                        help='reuse creation times of unchanged files from a metadata cache \
+                              (default location: ' + CACHE_NAME + ')')
+    parser.add_argument('--journal', metavar='name',
+                        help='record planned and completed renames in named journal')
+    parser.add_argument('--resume', action='store_true',
+                        help='finish the renames planned in the journal and skip the files \
+                              it renamed')
+    parser.add_argument('-t', '--tree', metavar='name', nargs='?', const='',
+                        help='move photos to sub-folders yyyy/mm/dd of named location \
+                              (default: location of the processed files)')
+    parser.add_argument('-g', '--group', action='store_true',
+                        help='rename files sharing the name up to the first dot (e.g. raw file, \
+                              jpeg and xmp sidecar) together under one new name')
+    parser.add_argument('-d', '--dedup', choices=DEDUP_ACTIONS,
+                        help='skip, hard link or delete files identical to a file with the same \
+                              creation time in the target location')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='keep renaming new photos written to the named location')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='only print the planned renames')
+    parser.add_argument('--stats', choices=['json'],
+                        help='print counters and per-stage timing of the run to stderr')
+    parser.add_argument('--profile', metavar='name', nargs='?', const='rename_photos.prof',
+                        help='save cProfile output to named file (default: rename_photos.prof)')
     args = parser.parse_args()
 
+    # stop on SIGTERM as on ctrl-c, so the cache and the journal are closed properly
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    if args.profile is None:
+        return run(args)
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(run, args)
+    finally:
+        profiler.dump_stats(args.profile)
+
+def run(args):
+    '''
+    Rename photo(s) as requested by the command-line arguments parsed in rename_photos().
+    Args:
+        args: argparse namespace
+    '''
+
+    # undo previous run
+    if args.undo is not None:
+        if not os.path.isfile(args.undo):
+            print('\nplease provide a valid journal name\n')
+            return
+        journal = RenameJournal(args.undo)
+        undo_renames(journal)
+        journal.close()
+        return
+
+    # collect run statistics
+    stats = RunStats() if args.stats is not None else None
+
     # parse arguments
-    path = None
     files = None
     if args.file is not None and os.path.isfile(args.file):
-        data = args.file.rpartition('/')
-        path = data[0] + data[1]
-        files = [data[2]]
+        if not is_photo(os.path.basename(args.file)):
+            print ('\n"' + args.file + '" is not a valid file...skipping\n')
+            return
+        files = get_group_files(args.file) if args.group else [args.file]
     elif args.path is not None and os.path.isdir(args.path):
-        path = args.path if args.path[-1] == '/' else args.path + '/'  # path must end with '/'
-        files = os.listdir(path)
+        files = (watch_photos(args.path, stats=stats) if args.watch else
+                 scan_photos(args.path, args.recursive, args.group, stats))
+    elif args.import_from is not None and os.path.isdir(args.import_from):
+        files = (watch_photos(args.import_from, stats=stats) if args.watch else
+                 scan_photos(args.import_from, args.recursive, args.group, stats))
+    elif args.serve is not None:
+        if args.watch or args.ordered or args.resume:
+            print('\nserver mode can\'t be used with --watch, --ordered or --resume\n')
+            return
+        files = []
     else:
         print('\nplease provide a valid file or path name\n')
         return
+    if args.group and (args.watch or args.ordered):
+        print('\nfiles can\'t be grouped in watch mode or when read in on-disk order\n')
+        return
+    if args.asyncio and args.watch:
+        print('\nthe asyncio pipeline can\'t be used in watch mode\n')
+        return
+    if args.import_from is not None and (args.into is None or args.journal is not None):
+        print('\nplease provide the location to import to (imports are not journaled)\n')
+        return
+    if args.jobs < 1:
+        print('\nplease provide a positive number of jobs\n')
+        return
+    if not 0 <= args.verify <= 1:
+        print('\nplease provide a fraction between 0 and 1 to verify\n')
+        return
+    if args.resume and args.journal is None:
+        print('\nplease provide the journal of the run to resume\n')
+        return
 
-    # store generated names to check for duplicates
-    names = dict()
+    # store existing and generated names to check for duplicates
+    names = NameIndex()
 
-    # valid file extensions
-    ftypes = ['nef', 'dng', 'jpg', 'jpeg']
+    # open rename journal
+    journal = RenameJournal(args.journal) if args.journal is not None else None
 
-    # process files
-    for file in files:
-        ftype = file.split('.')[-1].lower()
+    # resume interrupted run
+    if args.resume:
+        # finish planned renames; a missing source means the rename went through
+        failed = set()  # sources left to be planned again
+        for src, dst in list(journal.pending.items()):
+            if args.dry_run:
+                print (src + '\t->\t' + os.path.basename(dst))
+                continue
+            try:
+                if os.path.isfile(src):
+                    rename_noreplace(src, dst)
+                    print ('renaming ' + src + '\tto\t' + os.path.basename(dst))
+                elif not os.path.isfile(dst):
+                    raise FileNotFoundError
+            except OSError:
+                print ('\nunable to resume renaming "' + src + '", planning it again\n')
+                failed.add(src)
+                continue
+            journal.complete(src, dst)
 
-        # skip if directory, hidden file, or invalid file type
-        if not os.path.isfile(path + file) or file.startswith('.') or ftype not in ftypes:
-            print ('\n"' + file + '" is not a valid file...skipping\n')
-            continue
+        # skip files renamed by the previous run and, in a dry run, the ones it still renames;
+        # other paths in the journal may hold new files (e.g. camera names reused on a new card)
+        handled = set(dst for src, dst in journal.done) | (set(journal.pending) - failed)
+        files = (file for file in files if os.path.abspath(file) not in handled)
 
-        # read exif data
-        photo = open(path + file, 'rb')
-        data = exifread.process_file(photo)
-        photo.close()
+    # read files in on-disk order
+    if args.ordered:
+        files = prefetch_files(schedule_reads(files), max(64, 4 * args.jobs))
 
-        # skip if file creation time not found
-        if 'EXIF DateTimeOriginal' not in data.keys():
-            print ('\nunable to extract creation time from "' + file + '"...skipping\n')
-            continue
+    # open metadata cache
+    cache = ExifCache(args.cache) if args.cache is not None else None
 
-        # construct new name as: yyyymmdd_hhmmss(_cc)
-        name = str(data['EXIF DateTimeOriginal']).replace(' ', '_').replace(':', '')
-        if name not in names:
-            names[name] = 1
+    # root folder of date-partitioned tree
+    tree = args.tree
+    if tree == '':
+        if args.import_from is not None:
+            tree = args.into
         else:
-            names[name] += 1
-            name += '_{:0>2}'.format(names[name])
-        name += '.' + ftype
+            tree = args.path if args.path is not None else os.path.dirname(args.file or '')
 
-        # rename file
-        print ('renaming ' + file + '\tto\t' + name)
-        os.rename(path + file, path + name)
+    try:
+        if args.serve is not None:
+            # handle requests until stopped
+            serve_renames(args, names, cache, journal, stats)
+        else:
+            # plan and apply renames; in watch mode each photo is renamed as soon as it arrives
+            ahead = 0 if args.watch or args.file is not None else None
+            plan = plan_renames(
+                files, jobs=args.jobs, cache=cache, names=names, ahead=ahead, tree=tree,
+                into=args.into if args.import_from is not None else None,
+                dedup=args.dedup is not None, group=args.group, stats=stats,
+                skip_named=args.skip_named, verify=args.verify, subsec=args.subsec,
+                reader=read_creation_times_async if args.asyncio else read_creation_times)
+            if args.dry_run:
+                for steps in plan:
+                    for step in steps:
+                        print (step.src + '\t->\t' + (step.dst if step.duplicate is None else
+                                                       'duplicate of ' + step.duplicate))
+            else:
+                apply_plan(plan, names=names, journal=journal, copy=args.import_from is not None,
+                           dedup=args.dedup or 'skip', stats=stats)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if cache is not None:
+            cache.close()
+        if journal is not None:
+            journal.close()
+    if stats is not None:
+        print (json.dumps(stats.to_dict()), file=sys.stderr)
 
 if __name__ == '__main__':
     rename_photos()
@@ -0,0 +1,128 @@
+#! /usr/local/bin/python3
+
+import struct
+import time as clock
+
+import pytest
+from bench_rename_photos import make_jpeg, make_tiff
+from rename_photos import (CR3_UUID, MAC_EPOCH, get_creation_time, read_cr3_time, read_heic_time,
+                           read_jpeg_time, read_raw_time, read_video_time)
+
+TIME = '2024:01:02 03:04:05'
+
+def make_box(kind, payload):
+    ''' Return an iso base media file format box of type 'kind'. '''
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+def make_heic(tiff):
+    '''
+    Return a minimal heic file holding 'tiff' as its 'Exif' item, listed after an image item and
+    located through iloc (version 0, 4 byte offsets and lengths).
+    '''
+
+    ftyp = make_box(b'ftyp', b'heic' + bytes(4) + b'mif1heic')
+    infe = [make_box(b'infe', struct.pack('>BxxxHH4s', 2, item_id, 0, kind) + b'\x00')
+            for item_id, kind in ((1, b'hvc1'), (2, b'Exif'))]
+    iinf = make_box(b'iinf', bytes(4) + struct.pack('>H', len(infe)) + b''.join(infe))
+    item = bytes(4) + tiff  # offset of the tiff header, followed by the tiff structure
+
+    # the offsets in iloc don't change its size, so the layout is known up front
+    def iloc(offset):
+        entries = [(1, offset + len(item), 1), (2, offset, len(item))]
+        return make_box(b'iloc', bytes(4) + bytes([0x44, 0x00]) + struct.pack('>H', 2) +
+                        b''.join(struct.pack('>HHHII', item_id, 0, 1, start, length)
+                                 for item_id, start, length in entries))
+    meta_size = len(make_box(b'meta', bytes(4) + iinf + iloc(0)))
+    offset = len(ftyp) + meta_size + 8
+    meta = make_box(b'meta', bytes(4) + iinf + iloc(offset))
+    return ftyp + meta + make_box(b'mdat', item + bytes(16))
+
+def make_cr3(time):
+    ''' Return a minimal canon cr3 file with DateTimeOriginal in moov/uuid/CMT2. '''
+
+    # CMT2 holds the exif IFD itself: point the tiff header at it instead of at IFD0
+    tiff = make_tiff(time)
+    cmt2 = tiff[:4] + tiff[18:22] + tiff[8:]
+    uuid = make_box(b'uuid', CR3_UUID + make_box(b'CMT1', make_tiff()) + make_box(b'CMT2', cmt2))
+    return (make_box(b'ftyp', b'crx ' + bytes(4) + b'crx isom') +
+            make_box(b'moov', make_box(b'uuid', bytes(16)) + uuid) + make_box(b'mdat', bytes(16)))
+
+def make_mp4(seconds, version=0):
+    ''' Return a minimal mp4 file with creation time 'seconds' (since 1904) in moov/mvhd. '''
+
+    if version == 0:
+        mvhd = struct.pack('>BxxxII', 0, seconds, seconds) + bytes(88)
+    else:
+        mvhd = struct.pack('>BxxxQQ', 1, seconds, seconds) + bytes(96)
+    return (make_box(b'ftyp', b'isom' + bytes(4) + b'isommp41') +
+            make_box(b'moov', make_box(b'mvhd', mvhd)) + make_box(b'mdat', bytes(16)))
+
+def read(tmp_path, extractor, data, name='photo'):
+    ''' Write 'data' to a file and return the result of 'extractor' on it. '''
+
+    file = tmp_path / name
+    file.write_bytes(data)
+    with open(file, 'rb') as f:
+        return extractor(f)
+
+def get_creation_time_of(tmp_path, ftype, data):
+    ''' Write 'data' to a file with extension 'ftype' and return its creation time. '''
+
+    file = tmp_path / ('photo.' + ftype)
+    file.write_bytes(data)
+    return get_creation_time(str(file))
+
+@pytest.fixture
+def utc(monkeypatch):
+    ''' Run in the UTC time zone, so video creation times are predictable. '''
+
+    monkeypatch.setenv('TZ', 'UTC')
+    clock.tzset()
+    yield
+    monkeypatch.undo()
+    clock.tzset()
+
+@pytest.mark.parametrize('order', ['<', '>'])
+def test_jpeg(tmp_path, order):
+    assert read(tmp_path, read_jpeg_time, make_jpeg(make_tiff(TIME, order=order))) == TIME
+    assert read(tmp_path, read_jpeg_time,
+                make_jpeg(make_tiff(TIME, '123', 1000, order))) == TIME + '.123'
+    assert read(tmp_path, read_jpeg_time, make_jpeg(make_tiff(order=order))) is None
+
+@pytest.mark.parametrize('order', ['<', '>'])
+def test_tiff(tmp_path, order):
+    assert read(tmp_path, read_raw_time, make_tiff(TIME, order=order)) == TIME
+    assert read(tmp_path, read_raw_time, make_tiff(TIME, '5', order=order)) == TIME + '.500'
+    assert read(tmp_path, read_raw_time, make_tiff('not a time', order=order)) is None
+
+def test_heic(tmp_path):
+    assert read(tmp_path, read_heic_time, make_heic(make_tiff(TIME, '42'))) == TIME + '.420'
+    assert read(tmp_path, read_heic_time, make_heic(make_tiff(order='>'))) is None
+
+def test_cr3(tmp_path):
+    assert read(tmp_path, read_cr3_time, make_cr3(TIME)) == TIME
+    assert read(tmp_path, read_cr3_time, make_mp4(1)) is None
+
+@pytest.mark.parametrize('version', [0, 1])
+def test_mp4(tmp_path, utc, version):
+    seconds = MAC_EPOCH + 1704164645  # 2024-01-02 03:04:05 UTC
+    assert read(tmp_path, read_video_time, make_mp4(seconds, version)) == TIME
+    assert read(tmp_path, read_video_time, make_mp4(0, version)) is None
+
+def test_container_type(tmp_path):
+    # files with a misleading extension are read by the parser of their container format
+    for name, data in (('a.jpg', make_tiff(TIME)), ('b.dng', make_jpeg(make_tiff(TIME))),
+                       ('c.mp4', make_heic(make_tiff(TIME))), ('d.heic', make_cr3(TIME))):
+        (tmp_path / name).write_bytes(data)
+        assert get_creation_time(str(tmp_path / name)) == TIME
+
+def test_truncated(tmp_path, utc):
+    samples = [('jpg', make_jpeg(make_tiff(TIME, '123', order='>'))),
+               ('dng', make_tiff(TIME, '123')), ('heic', make_heic(make_tiff(TIME))),
+               ('cr3', make_cr3(TIME)), ('mp4', make_mp4(MAC_EPOCH + 1704164645, 1))]
+    for ftype, data in samples:
+        expected = get_creation_time_of(tmp_path, ftype, data)
+        assert expected is not None
+        # a cut off SubSecTimeOriginal leaves the time without fraction of a second
+        for size in range(len(data)):
+            assert get_creation_time_of(tmp_path, ftype, data[:size]) in (None, TIME, expected)